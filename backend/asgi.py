@@ -0,0 +1,212 @@
+"""
+ASGI entry point. The public listing reads are served by async handlers on a
+shared Motor connection pool, so a widely shared link does not tie up one
+thread per request waiting on Mongo. Every other request, including photos,
+falls through to the Flask app, as does everything with the SQLite storage
+backend.
+
+    uvicorn asgi:app --workers 4
+"""
+import contextlib
+import math
+import os
+from a2wsgi import WSGIMiddleware
+from flask_login.utils import decode_cookie
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from config import Config
+from db import client_options, profile_options
+from metrics import command_metrics
+from querylog import query_log
+from cache import preview_cache, user_cache, MISSING
+from invalidation import cache_invalidator
+from ratelimit import rate_limiter
+from user import user_from_document
+from app import app as flask_app
+from routes import start_index_bootstrap
+from routes.listing import (
+    DETAILS_PROJECTION, PREVIEW_PROJECTION, VERSION_PROJECTION, cache_preview,
+    can_view_listing, can_view_listings, details_etag, preview_body, with_photo_urls
+)
+import logging
+logger = logging.getLogger('lucky_house')
+
+_client = None
+
+def get_database(profile='primary'):
+    """
+    One Motor client (and connection pool) per worker process, opened on first
+    use; profile routes reads as in db.profile_options.
+    """
+    global _client
+    if _client is None:
+        options = client_options()
+        options["maxPoolSize"] = Config.ASGI_MONGO_POOL_SIZE
+        _client = AsyncIOMotorClient(os.getenv("MONGO_URI"), event_listeners=[command_metrics, query_log], **options)
+    return _client.get_database('lucky_house', **profile_options(profile))
+
+def session_username(request):
+    """
+    The username flask_login would load for this request: from the signed
+    Flask session cookie, else from the remember-me cookie.
+    """
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    session_cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if serializer is not None and session_cookie:
+        try:
+            max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+            username = serializer.loads(session_cookie, max_age=max_age).get('_user_id')
+            if username:
+                return username
+        except Exception:
+            pass
+
+    remember_cookie = request.cookies.get(flask_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+    if remember_cookie:
+        with flask_app.app_context():
+            return decode_cookie(remember_cookie)
+    return None
+
+async def load_user(request):
+    """Async twin of the Flask user_loader, sharing its cache."""
+    username = session_username(request)
+    if not username:
+        return None
+    cached = user_cache.get(username)
+    if cached is not MISSING:
+        return cached
+    user = await get_database()['users'].find_one({'username': username})
+    if not user:
+        logger.error('No user found with username %s', username)
+        return None
+    loaded = user_from_document(user)
+    user_cache.set(username, loaded)
+    return loaded
+
+async def rate_limited(request, endpoint):
+    """429 response if the client is over its limit for endpoint, else None."""
+    if not Config.RATE_LIMIT_ENABLED:
+        return None
+    keys = {'ip': request.client.host if request.client else None}
+    if rate_limiter.buckets.shared:
+        wait = await run_in_threadpool(rate_limiter.check, endpoint, keys)
+    else:
+        wait = rate_limiter.check(endpoint, keys)
+    if not wait:
+        return None
+    return JSONResponse({"message": "Too many requests"}, 429, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+async def get_public_listing(request):
+    url_token = request.path_params['url_token']
+    limited = await rate_limited(request, 'listing.get_public_listing')
+    if limited:
+        return limited
+    try:
+        preview = preview_cache.get(url_token)
+        if preview is MISSING:
+            # Cached previews are filled from the primary, as in routes/listing.py
+            listing = await get_database()['listings'].find_one({"url": url_token}, PREVIEW_PROJECTION)
+            preview = cache_preview(url_token, listing)
+        if not preview:
+            logger.error('Listing with token %s not found', url_token)
+            return JSONResponse({"message": "Listing not found"}, 404)
+
+        data, etag = preview
+        headers = {
+            "ETag": f'"{etag}"',
+            "Cache-Control": f"public, max-age={Config.PREVIEW_MAX_AGE}",
+        }
+        if f'"{etag}"' in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return json_response(preview_body(url_token, data, base_url=str(request.base_url)), headers)
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return JSONResponse({"message": "An error occurred"}, 500)
+
+async def get_listing_details(request):
+    url_token = request.path_params['url_token']
+    try:
+        current_user = await load_user(request)
+        if current_user is None:
+            logger.error('Unauthorized access')
+            return JSONResponse({"error": "Unauthorized"}, 401)
+
+        if not can_view_listings(current_user):
+            logger.error('User %s does not have permission to view listings', current_user.username)
+            return JSONResponse({"message": "Unauthorized"}, 403)
+
+        if not can_view_listing(current_user, url_token):
+            logger.error('Viewer %s does not have access to listing %s', current_user.username, url_token)
+            return JSONResponse({"message": "Unauthorized"}, 403)
+
+        listings = get_database('public')['listings']
+        version = await listings.find_one({"url": url_token}, VERSION_PROJECTION)
+        if not version:
+            logger.error('Listing with token %s not found', url_token)
+            return JSONResponse({"message": "Listing not found"}, 404)
+
+        headers = details_headers(details_etag(version))
+        if headers["ETag"] in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+
+        listing = await listings.find_one({"url": url_token}, DETAILS_PROJECTION)
+        if not listing:
+            logger.error('Listing with token %s not found', url_token)
+            return JSONResponse({"message": "Listing not found"}, 404)
+
+        headers = details_headers(details_etag(listing))
+        listing.pop("uid", None)
+        listing.pop("photo_jobs", None)
+        return json_response(with_photo_urls(listing, base_url=str(request.base_url)), headers)
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return JSONResponse({"message": "An error occurred"}, 500)
+
+def details_headers(etag):
+    return {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+
+def json_response(body, headers=None):
+    """Encode with the Flask app's JSON provider so both modes serialize alike (e.g. dates)."""
+    return Response(flask_app.json.dumps(body), media_type="application/json", headers=headers)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global _client
+    if Config.CACHE_INVALIDATION:
+        cache_invalidator.ensure_started()
+    if Config.ENSURE_INDEXES and Config.STORAGE_BACKEND == 'mongo':
+        # Async routes never run Flask's before_request hooks
+        start_index_bootstrap()
+    yield
+    if _client is not None:
+        _client.close()
+        _client = None
+
+wsgi_app = WSGIMiddleware(flask_app)
+
+async_routes = [
+    # Flask routes that would otherwise match /listing/{url_token}
+    Route("/listing/search", wsgi_app, methods=["GET"]),
+    Route("/listing/{url_token}", get_public_listing, methods=["GET"]),
+    Route("/listing/{url_token}/details", get_listing_details, methods=["GET"]),
+]
+
+app = Starlette(
+    routes=(async_routes if Config.STORAGE_BACKEND == 'mongo' else []) + [Mount("/", app=wsgi_app)],
+    # Same policy as the flask_cors setup in routes/__init__.py
+    middleware=[Middleware(
+        CORSMiddleware,
+        allow_origin_regex=".*",
+        allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+        allow_headers=["Content-Type", "Authorization"],
+        expose_headers=["Content-Type", "Link", "X-Next-Cursor", "X-Request-ID"],
+        allow_credentials=True,
+        max_age=86400,
+    )],
+    lifespan=lifespan,
+)
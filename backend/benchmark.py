@@ -0,0 +1,250 @@
+"""
+Load test the API in-process and write the results as JSON.
+
+Runs against an in-memory Mongo stand-in (mongomock) by default, a local
+mongod with --mongo-uri (set MONGO_TLS=false for a plain local server), or
+the embedded SQLite storage backend in a temporary file with --backend sqlite:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --mongo-uri mongodb://localhost:27017 --output bench.json
+    python benchmark.py --backend sqlite --output sqlite.json
+    python benchmark.py --compare before.json after.json
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from io import BytesIO
+from PIL import Image
+from config import Config
+from db import MongoConnector, mongomock_client
+
+SCENARIOS = ['login', 'public_listing', 'listing_details', 'admin_listing_get', 'admin_listing_create']
+BENCH_PASSWORD = 'bench-password'
+
+def make_photo(seed, size=(1600, 1200)):
+    """A noisy JPEG data URL of phone-photo proportions; noise keeps it hard to compress."""
+    rng = random.Random(seed)
+    img = Image.effect_noise(size, 40 + seed % 20).convert('RGB')
+    tint = Image.new('RGB', size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    img = Image.blend(img, tint, 0.4)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=92)
+    return 'data:image/jpeg;base64,' + base64.b64encode(output.getvalue()).decode('ascii')
+
+def use_database(mongo_uri):
+    connector = MongoConnector()
+    if mongo_uri:
+        connector.uri = mongo_uri
+    else:
+        connector.use_client(mongomock_client())
+    return connector
+
+def seed(connector, args, photos):
+    from passwords import hash_password
+    from photo_store import store_uploads
+    from repositories import storage
+
+    if connector is not None:
+        db = connector.get_database()
+        for name in ('users', 'viewers', 'listings', 'photos.files', 'photos.chunks'):
+            db[name].delete_many({})
+
+    # One hash for everyone; hashing each account would dominate seeding
+    password_hash = hash_password(BENCH_PASSWORD)
+    listings = [f'bench-listing-{i}' for i in range(args.listings)]
+    storage.users.insert_many(
+        [{"username": "bench-admin", "password_hash": password_hash, "user_type": "admin"}] + [
+            {"username": f"bench-user-{i}", "password_hash": password_hash, "user_type": "tenant",
+             "first_name": "Bench", "last_name": str(i), "email": f"user{i}@example.com",
+             "listing_url": listings[i % len(listings)]}
+            for i in range(args.users)
+        ]
+    )
+    storage.viewers.insert_many([
+        {"username": f"bench-viewer-{i}", "password": BENCH_PASSWORD, "listing_url": listings[i % len(listings)]}
+        for i in range(args.viewers)
+    ])
+
+    photo_ids = store_uploads(photos)
+    for i, url in enumerate(listings):
+        storage.listings.insert(
+            {"url": url, "name": f"Listing {i}", "address": f"{i} Bench Street",
+             "description": "Two bedroom apartment " * 20, "open": True, "version": 1,
+             "photos": [photo_ids[(i + j) % len(photo_ids)] for j in range(args.photos_per_listing)]}
+        )
+    return listings
+
+def unique_photo(photo, n):
+    """Same image with different bytes (data after the JPEG end marker), so uploads don't dedupe."""
+    data = base64.b64decode(photo.split(',', 1)[1]) + n.to_bytes(8, 'big')
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii')
+
+def build_request(scenario, n, listings, photos, args):
+    """(method, path, json body) of the n-th request of a scenario."""
+    if scenario == 'login':
+        user = f'bench-user-{n % max(args.users, 1)}'
+        return 'POST', '/auth/login', {"username": user, "password": BENCH_PASSWORD}
+    if scenario == 'public_listing':
+        return 'GET', f'/listing/{random.choice(listings)}', None
+    if scenario == 'listing_details':
+        return 'GET', f'/listing/{random.choice(listings)}/details', None
+    if scenario == 'admin_listing_get':
+        return 'GET', '/admin/listing/get', None
+    if scenario == 'admin_listing_create':
+        return 'POST', '/admin/listing/create', {
+            "url": f'bench-new-{os.getpid()}-{n}', "name": f"New {n}", "address": "1 Bench Street",
+            "open": True, "photos": [unique_photo(photo, n) for photo in photos[:args.photos_per_listing]]
+        }
+    raise ValueError(scenario)
+
+def run_scenario(app, scenario, listings, photos, args):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(args.requests))
+    # Clients log in before the clock starts
+    ready = threading.Barrier(args.concurrency + 1)
+
+    def worker():
+        nonlocal errors
+        client = app.test_client()
+        if scenario != 'login':
+            client.post('/auth/login', json={"username": "bench-admin", "password": BENCH_PASSWORD})
+        ready.wait()
+        while True:
+            with lock:
+                n = next(remaining, None)
+            if n is None:
+                return
+            method, path, body = build_request(scenario, n, listings, photos, args)
+            started = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    def percentile(p):
+        return 1000 * latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall else 0,
+        "mean_ms": 1000 * statistics.fmean(latencies),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        # ru_maxrss is in KB on Linux; children are the compression workers
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f'{"scenario":<22}{"metric":<16}{"before":>12}{"after":>12}{"change":>10}')
+    for scenario, results in after["scenarios"].items():
+        old = before["scenarios"].get(scenario)
+        if not old:
+            continue
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb'):
+            change = (results[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0
+            print(f'{scenario:<22}{metric:<16}{old[metric]:>12.2f}{results[metric]:>12.2f}{change:>+9.1f}%')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['mongo', 'sqlite'], default='mongo', help='Storage backend to benchmark')
+    parser.add_argument('--mongo-uri', help='Benchmark against this mongod instead of mongomock')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--viewers', type=int, default=200)
+    parser.add_argument('--listings', type=int, default=100)
+    parser.add_argument('--photos-per-listing', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Diff two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    random.seed(args.seed)
+    # Expected 401s and the like would otherwise go to stderr
+    logging.getLogger('lucky_house').addHandler(logging.NullHandler())
+    # Listing creates queue photo jobs; keep that queue (and SQLite data) out of the working directory
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    Config.JOBS_DATABASE = os.path.join(workdir, 'jobs.sqlite')
+    Config.STORAGE_BACKEND = args.backend
+    Config.SQLITE_DATABASE = os.path.join(workdir, 'lucky_house.sqlite')
+    connector = use_database(args.mongo_uri) if args.backend == 'mongo' else None
+
+    from routes import create_app
+    from indexes import ensure_indexes
+
+    class BenchConfig(Config):
+        # Created synchronously below instead
+        ENSURE_INDEXES = False
+        SECRET_KEY = Config.SECRET_KEY or 'benchmark'
+        # mongomock has no change streams; keep cache TTLs comparable across runs
+        CACHE_INVALIDATION = False
+        # Every simulated client shares one address and one admin account
+        RATE_LIMIT_ENABLED = False
+
+    app = create_app(BenchConfig)
+    if connector is not None:
+        ensure_indexes(connector.get_database())
+
+    photos = [make_photo(args.seed + i) for i in range(max(args.photos_per_listing, 1) * 2)]
+    listings = seed(connector, args, photos)
+
+    results = {
+        "commit": git_commit(),
+        "backend": 'sqlite' if args.backend == 'sqlite' else 'mongod' if args.mongo_uri else 'mongomock',
+        "settings": {key: value for key, value in vars(args).items() if key not in ('compare', 'output', 'mongo_uri', 'backend')},
+        "scenarios": {},
+    }
+    for scenario in args.scenarios.split(','):
+        results["scenarios"][scenario] = run_scenario(app, scenario, listings, photos, args)
+        r = results["scenarios"][scenario]
+        print(f'{scenario:<22}{r["throughput_rps"]:>9.1f} req/s  p50 {r["p50_ms"]:.1f}ms  '
+              f'p95 {r["p95_ms"]:.1f}ms  p99 {r["p99_ms"]:.1f}ms  errors {r["errors"]}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+
+MISSING = object()
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_ttl = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """Return the cached value, or default (MISSING) if absent or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def limit_ttl(self, max_ttl):
+        """Cap the lifetime of entries, current ones included; None lifts the cap."""
+        with self._lock:
+            self.max_ttl = max_ttl
+            if max_ttl is not None:
+                deadline = time.monotonic() + max_ttl
+                for key, (value, expires_at) in list(self._data.items()):
+                    if expires_at > deadline:
+                        self._data[key] = (value, deadline)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+# Users rebuilt by the login manager's user_loader, keyed by username
+user_cache = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+# Rendered public listing previews, keyed by url token; None marks a miss
+preview_cache = TTLCache(Config.PREVIEW_CACHE_SIZE, Config.PREVIEW_CACHE_TTL)
@@ -3,11 +3,137 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+def _int_or_none(value):
+    return int(value) if value else None
+
+def _w_option(value):
+    """Write concern w is a node count or a tag such as 'majority'."""
+    if not value:
+        return None
+    return int(value) if value.isdigit() else value
+
 class Config:
     SQLALCHEMY_DATABASE_URI = "sqlite:///db.sqlite"
+    # Where users, viewers, listings and photos live: mongo, or sqlite for an
+    # embedded single-node database in SQLITE_DATABASE (repositories.py)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo')
+    SQLITE_DATABASE = os.getenv('SQLITE_DATABASE', 'lucky_house.sqlite')
+    # Photo job queue (jobs.py), a SQLite file shared by web and worker processes
+    JOBS_DATABASE = os.getenv('JOBS_DATABASE', SQLALCHEMY_DATABASE_URI[len('sqlite:///'):])
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+    JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', 5))  # seconds, doubled per attempt
+    JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 120))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))
     SECRET_KEY = os.getenv('SECRET_KEY')
     # Cookie settings
     REMEMBER_COOKIE_SECURE = True  # For HTTPS
     REMEMBER_COOKIE_HTTPONLY = True
     REMEMBER_COOKIE_SAMESITE = 'Lax'
-    PERMANENT_SESSION_LIFETIME = 86400  # 24 hours in seconds
\ No newline at end of file
+    PERMANENT_SESSION_LIFETIME = 86400  # 24 hours in seconds
+    # Admin list endpoints (keyset pagination)
+    ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 100))
+    ADMIN_MAX_PAGE_SIZE = int(os.getenv('ADMIN_MAX_PAGE_SIZE', 500))
+    # Photo compression process pool (0 workers compresses on the request thread)
+    PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', os.cpu_count() or 1))
+    PHOTO_QUEUE_SIZE = int(os.getenv('PHOTO_QUEUE_SIZE', 2 * PHOTO_WORKERS or 1))
+    PHOTO_TIMEOUT = float(os.getenv('PHOTO_TIMEOUT', 30))
+    # Renditions generated for every photo: name -> (max edge in px, max size in KB)
+    PHOTO_RENDITIONS = {
+        'full': (int(os.getenv('PHOTO_MAX_EDGE', 2048)), 500),
+        'medium': (1024, 150),
+        'thumb': (320, 30),
+    }
+    # Multipart photo uploads: files spill from memory to disk past the spool size
+    PHOTO_UPLOAD_MAX_BYTES = int(os.getenv('PHOTO_UPLOAD_MAX_BYTES', 20 * 1024 * 1024))
+    PHOTO_UPLOAD_MAX_FILES = int(os.getenv('PHOTO_UPLOAD_MAX_FILES', 50))
+    PHOTO_UPLOAD_SPOOL_SIZE = int(os.getenv('PHOTO_UPLOAD_SPOOL_SIZE', 1024 * 1024))
+    PHOTO_UPLOAD_FORMATS = ['JPEG', 'MPO', 'PNG', 'WEBP', 'GIF']
+    # Larger images are rejected from their header, before being decoded
+    PHOTO_MAX_PIXELS = int(os.getenv('PHOTO_MAX_PIXELS', 50_000_000))
+    # Largest request body Flask accepts (413 past it), JSON uploads included
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 256 * 1024 * 1024))
+    # Cap on JPEG encodes spent searching for a quality that fits
+    PHOTO_MAX_QUALITY_STEPS = 7
+    # load_user cache; admin user mutations invalidate entries immediately
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+    # Password hashing pool; requests beyond workers + queue get a 503
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+    PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 16))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+    PASSWORD_HASH_RETRY_AFTER = 1
+    # Create missing Mongo indexes when the app starts
+    ENSURE_INDEXES = os.getenv('ENSURE_INDEXES', 'true').lower() == 'true'
+    # Rows written per bulk_write by the bulk provisioning endpoints
+    BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 500))
+    # Connection pool of the async Mongo client used by asgi.py
+    ASGI_MONGO_POOL_SIZE = int(os.getenv('ASGI_MONGO_POOL_SIZE', 100))
+    # Public listing preview cache; not-found tokens are cached for a short time
+    PREVIEW_CACHE_SIZE = int(os.getenv('PREVIEW_CACHE_SIZE', 4096))
+    PREVIEW_CACHE_TTL = float(os.getenv('PREVIEW_CACHE_TTL', 300))
+    PREVIEW_NEGATIVE_TTL = float(os.getenv('PREVIEW_NEGATIVE_TTL', 10))
+    # Evict cache entries changed by other workers, from a Mongo change stream.
+    # Without change streams, cached entries live CACHE_POLL_TTL seconds at most.
+    CACHE_INVALIDATION = os.getenv('CACHE_INVALIDATION', 'true').lower() == 'true'
+    CACHE_POLL_TTL = float(os.getenv('CACHE_POLL_TTL', 5))
+    CACHE_STREAM_RETRY = float(os.getenv('CACHE_STREAM_RETRY', 30))
+    # Cache-Control max-age for previews; clients revalidate with the ETag after
+    PREVIEW_MAX_AGE = int(os.getenv('PREVIEW_MAX_AGE', 60))
+    # Documents per cursor batch when admin list endpoints stream
+    ADMIN_STREAM_BATCH_SIZE = int(os.getenv('ADMIN_STREAM_BATCH_SIZE', 100))
+    # MongoClient pool, timeouts and concerns (unset keeps pymongo's default)
+    MONGO_TLS = os.getenv('MONGO_TLS', 'true').lower() == 'true'
+    MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+    MONGO_MAX_IDLE_TIME_MS = _int_or_none(os.getenv('MONGO_MAX_IDLE_TIME_MS'))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = _int_or_none(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS'))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 10000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+    MONGO_SOCKET_TIMEOUT_MS = _int_or_none(os.getenv('MONGO_SOCKET_TIMEOUT_MS'))
+    MONGO_RETRY_WRITES = os.getenv('MONGO_RETRY_WRITES', 'true').lower() == 'true'
+    MONGO_READ_CONCERN = os.getenv('MONGO_READ_CONCERN')  # e.g. local, majority
+    MONGO_WRITE_CONCERN = _w_option(os.getenv('MONGO_WRITE_CONCERN'))  # e.g. 1, majority
+    # Public and viewer reads use this read preference, from members at most
+    # MONGO_MAX_STALENESS_SECONDS behind (90 or more, -1 for no bound); auth and
+    # admin reads stay on the primary
+    MONGO_PUBLIC_READ_PREFERENCE = os.getenv('MONGO_PUBLIC_READ_PREFERENCE', 'secondaryPreferred')
+    MONGO_MAX_STALENESS_SECONDS = int(os.getenv('MONGO_MAX_STALENESS_SECONDS', 90))
+    MONGO_PUBLIC_READ_CONCERN = os.getenv('MONGO_PUBLIC_READ_CONCERN')  # e.g. local, available
+    # Write concern of bulk provisioning, migrations and the photo worker; must be
+    # acknowledged (GridFS refuses w=0)
+    MONGO_BULK_WRITE_CONCERN = _w_option(os.getenv('MONGO_BULK_WRITE_CONCERN'))  # e.g. 1, majority
+    MONGO_BULK_WTIMEOUT_MS = _int_or_none(os.getenv('MONGO_BULK_WTIMEOUT_MS'))
+    # Log the replica set member that served each read to lucky_house.reads
+    MONGO_LOG_READS = os.getenv('MONGO_LOG_READS', 'false').lower() == 'true'
+    # Token buckets by endpoint and scope: (tokens per second, burst)
+    RATE_LIMITS = {
+        'auth.login': {'ip': (1, 10), 'username': (0.2, 5)},
+        'auth.register': {'ip': (0.1, 5), 'username': (0.1, 2)},
+        'listing.get_public_listing': {'ip': (20, 60)},
+    }
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_STORAGE = os.getenv('RATE_LIMIT_STORAGE', 'memory')  # memory or mongo
+    RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+    # Number of proxies in front of the app whose X-Forwarded-For is trusted
+    PROXY_COUNT = int(os.getenv('PROXY_COUNT', 0))
+    # Requests a worker handles at once before answering 503 (0 for no cap)
+    MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', 64))
+    SHED_RETRY_AFTER = 1
+    SHED_EXEMPT = ['health', 'metrics']
+    # Commands slower than this (ms) are explained and written to the slow query
+    # log (0 turns it off); diagnostics logs and explains every query shape
+    MONGO_SLOW_QUERY_MS = float(os.getenv('MONGO_SLOW_QUERY_MS', 100))
+    MONGO_DIAGNOSTICS = os.getenv('MONGO_DIAGNOSTICS', 'false').lower() == 'true'
+    QUERY_PLAN_TTL = float(os.getenv('QUERY_PLAN_TTL', 300))
+    # Expose Prometheus metrics of each worker at /metrics
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    # Logging: records are queued and written by a background listener
+    LOG_DIR = os.getenv('LOG_DIR', 'logs')
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text or json
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    # Per-logger rate limit (records per second, burst) for chatty loggers
+    LOG_RATE_LIMITED = ['lucky_house.auth', 'lucky_house.ratelimit']
+    LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', 5))
+    LOG_RATE_BURST = int(os.getenv('LOG_RATE_BURST', 20))
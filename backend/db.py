@@ -1,26 +1,249 @@
 import os
-from pymongo import MongoClient
+import threading
+import time
+from types import SimpleNamespace
+from pymongo import MongoClient, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
 import certifi
 from dotenv import load_dotenv
 load_dotenv(override=True)
+from config import Config
+from metrics import command_metrics
+from querylog import query_log
+
+def client_options():
+    """MongoClient keyword arguments from Config; unset options keep pymongo's defaults."""
+    options = {
+        "maxPoolSize": Config.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": Config.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": Config.MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": Config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": Config.MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": Config.MONGO_SOCKET_TIMEOUT_MS,
+        "retryWrites": Config.MONGO_RETRY_WRITES,
+        "readConcernLevel": Config.MONGO_READ_CONCERN,
+        "w": Config.MONGO_WRITE_CONCERN,
+    }
+    if Config.MONGO_TLS:
+        options["tlsCAFile"] = certifi.where()
+    return {key: value for key, value in options.items() if value is not None}
+
+def mongomock_client():
+    """In-memory stand-in for MongoClient, GridFS included, for offline benchmarks and checks."""
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+    # GridFSBucket reads client.options.timeout, which mongomock lacks
+    client.options = SimpleNamespace(timeout=None)
+    return client
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+def read_preference(mode, max_staleness=-1):
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference: {mode}')
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=max_staleness)
+
+def profile_options(profile):
+    """
+    Collection options of a routing profile:
+      primary  reads on the primary, the client's default concerns (auth, admin)
+      public   reads by MONGO_PUBLIC_READ_PREFERENCE (public and viewer reads)
+      bulk     writes with MONGO_BULK_WRITE_CONCERN (bulk and background writes)
+    """
+    options = {}
+    if profile == 'public':
+        options["read_preference"] = read_preference(
+            Config.MONGO_PUBLIC_READ_PREFERENCE, Config.MONGO_MAX_STALENESS_SECONDS
+        )
+        if Config.MONGO_PUBLIC_READ_CONCERN:
+            options["read_concern"] = ReadConcern(Config.MONGO_PUBLIC_READ_CONCERN)
+    elif profile == 'bulk':
+        if Config.MONGO_BULK_WRITE_CONCERN is not None or Config.MONGO_BULK_WTIMEOUT_MS is not None:
+            options["write_concern"] = WriteConcern(
+                w=Config.MONGO_BULK_WRITE_CONCERN, wtimeout=Config.MONGO_BULK_WTIMEOUT_MS
+            )
+    elif profile != 'primary':
+        raise ValueError(f'Unknown routing profile: {profile}')
+    return options
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters and checkout wait times, fed by pymongo's pool events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Checkout events fire on the thread asking for the connection
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.open = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.pools_cleared = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _record_wait(self):
+        started = getattr(self._local, 'started', None)
+        waited = time.monotonic() - started if started is not None else 0.0
+        self._local.started = None
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "available": max(self.open - self.checked_out, 0),
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "pools_cleared": self.pools_cleared,
+                "wait_avg_ms": 1000 * self.wait_total / max(self.checkouts + self.checkout_failures, 1),
+                "wait_max_ms": 1000 * self.wait_max,
+            }
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self._record_wait()
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            self._record_wait()
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pools_cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+class LazyCollection:
+    """
+    Stands in for a pymongo Collection so modules can keep collections as
+    globals without opening a client at import time.
+    """
+
+    def __init__(self, connector, name, options=None):
+        self._connector = connector
+        self._name = name
+        self._options = options or {}
+        self._client = None
+        self._collection = None
+
+    def _resolve(self):
+        client = self._connector.client
+        if client is not self._client:
+            self._collection = client['lucky_house'].get_collection(self._name, **self._options)
+            self._client = client
+        return self._collection
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
 
 class MongoConnector:
-    # Single connection instance
+    # Single connector per process; the client itself is opened lazily
     _instance = None
 
-    def __new__(cls, uri=os.getenv("MONGO_URI")):
+    def __new__(cls, uri=None):
         if cls._instance is None:
             cls._instance = super(MongoConnector, cls).__new__(cls)
-            cls._instance.client = MongoClient(uri, tlsCAFile=certifi.where())
-            cls._instance.db = None
-            cls._instance.collection = None
+            cls._instance.uri = uri or os.getenv("MONGO_URI")
+            cls._instance.pool_stats = PoolStats()
+            cls._instance._reset()
+            # A MongoClient must not be shared across fork(): gunicorn workers
+            # drop the inherited one and open their own on first use
+            os.register_at_fork(after_in_child=cls._instance._reset)
         return cls._instance
-    
-    def get_collection(self, collection):
-        # Returns a reference to a specific collection to avoid race condition
-        return self.client['lucky_house'][collection]
+
+    def _reset(self):
+        self._client = None
+        self._lock = threading.Lock()
+        self.pool_stats.reset()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = MongoClient(
+                        self.uri,
+                        event_listeners=[self.pool_stats, command_metrics, query_log],
+                        **client_options()
+                    )
+        return self._client
+
+    def use_client(self, client):
+        """Use an already built client, e.g. an in-memory stand-in for benchmarks."""
+        with self._lock:
+            self._client = client
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    def get_database(self, **options):
+        """The app's database; options (see profile_options) route its reads and writes."""
+        return self.client.get_database('lucky_house', **options)
+
+    def get_collection(self, collection, **options):
+        # Resolved against this process's client on use
+        return LazyCollection(self, collection, options)
+
+    def members(self):
+        """Replica set members this process knows of, by address, with their type."""
+        if self._client is None:
+            return {}
+        return {
+            f'{host}:{port}': server.server_type_name
+            for (host, port), server in self._client.topology_description.server_descriptions().items()
+        }
 
     def close(self):
-        if self.client is not None:
-            self.client.close()
-            self.client = None
\ No newline at end of file
+        if self._client is not None:
+            self._client.close()
+            self._client = None
@@ -0,0 +1,47 @@
+from pymongo import ASCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+from search import TEXT_WEIGHTS
+import logging
+logger = logging.getLogger('lucky_house')
+
+# Every index the routes rely on, by collection. create_indexes is a no-op for
+# indexes that already exist with the same definition.
+INDEXES = {
+    'users': [
+        IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+        IndexModel([('listing_url', ASCENDING)], name='listing_url'),
+    ],
+    'viewers': [
+        IndexModel([('username', ASCENDING)], name='username_unique', unique=True),
+        IndexModel([('listing_url', ASCENDING)], name='listing_url'),
+    ],
+    'listings': [
+        IndexModel([('url', ASCENDING)], name='url_unique', unique=True),
+        # Listing search: filters on open, sorts by url or name (ending on url)
+        IndexModel([('open', ASCENDING), ('url', ASCENDING)], name='open_url'),
+        IndexModel([('name', ASCENDING), ('url', ASCENDING)], name='name_url'),
+        IndexModel([('open', ASCENDING), ('name', ASCENDING), ('url', ASCENDING)], name='open_name_url'),
+        IndexModel(
+            [('name', TEXT), ('address', TEXT), ('description', TEXT)],
+            name='listing_text', weights=TEXT_WEIGHTS
+        ),
+    ],
+    'rate_limits': [
+        # Buckets used with RATE_LIMIT_STORAGE=mongo, removed once idle
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'photos.files': [
+        IndexModel([('metadata.upload_sha256', ASCENDING)], name='upload_sha256', sparse=True),
+    ],
+}
+
+def ensure_indexes(db):
+    """Create missing indexes. Returns the names created or confirmed per collection."""
+    ensured = {}
+    for collection, indexes in INDEXES.items():
+        try:
+            ensured[collection] = db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. existing duplicates block a unique index; keep going
+            logger.error('Could not create indexes on %s: %s', collection, e)
+    return ensured
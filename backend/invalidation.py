@@ -0,0 +1,129 @@
+"""
+Evict in-process cache entries when another worker (or host) changes the
+documents behind them, by tailing a change stream on the users, viewers and
+listings collections from a background thread.
+
+Change streams need a replica set. Against a standalone server the caches
+fall back to entries of at most CACHE_POLL_TTL seconds, and the change
+stream is retried every CACHE_STREAM_RETRY seconds. The SQLite storage
+backend has no change feed, so it always polls.
+"""
+import os
+import threading
+import time
+from pymongo.errors import OperationFailure
+from config import Config
+from db import MongoConnector
+from cache import preview_cache, user_cache
+import logging
+logger = logging.getLogger('lucky_house')
+
+# Collection -> (cache, document field holding the cache key)
+TARGETS = {
+    'users': (user_cache, 'username'),
+    'viewers': (user_cache, 'username'),
+    'listings': (preview_cache, 'url'),
+}
+
+# The oplog no longer holds the resume point
+HISTORY_LOST_CODES = {280, 286}
+
+PIPELINE = [
+    {"$match": {"ns.coll": {"$in": list(TARGETS)}}},
+    {"$project": {
+        "operationType": 1, "ns": 1, "documentKey": 1,
+        "fullDocument.username": 1, "fullDocument.url": 1,
+        "updateDescription.updatedFields": 1,
+    }},
+]
+
+class CacheInvalidator:
+    def __init__(self, connector):
+        self.connector = connector
+        self.mode = 'stopped'
+        self.resume_token = None
+        self.evictions = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the watcher thread once per process (cheap to call per request)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits neither the thread nor a usable resume point
+            self._pid = os.getpid()
+            self.resume_token = None
+            if Config.STORAGE_BACKEND != 'mongo':
+                self.set_mode('polling')
+                return
+            threading.Thread(target=self.run, name='cache-invalidation', daemon=True).start()
+
+    def caches(self):
+        return {id(cache): cache for cache, _ in TARGETS.values()}.values()
+
+    def set_mode(self, mode):
+        if mode == self.mode:
+            return
+        logger.info('Cache invalidation mode: %s', mode)
+        self.mode = mode
+        for cache in self.caches():
+            cache.limit_ttl(Config.CACHE_POLL_TTL if mode == 'polling' else None)
+
+    def clear_all(self):
+        for cache in self.caches():
+            cache.clear()
+
+    def run(self):
+        while True:
+            try:
+                self.watch()
+            except OperationFailure as e:
+                if e.code in HISTORY_LOST_CODES:
+                    logger.error('Change stream history lost, clearing caches: %s', e)
+                    self.resume_token = None
+                    continue
+                self.fall_back(e)
+            except Exception as e:
+                self.fall_back(e)
+
+    def fall_back(self, error):
+        logger.error('Change stream unavailable, polling with short cache TTLs: %s', error)
+        self.set_mode('polling')
+        time.sleep(Config.CACHE_STREAM_RETRY)
+
+    def watch(self):
+        database = self.connector.get_database()
+        with database.watch(PIPELINE, full_document='updateLookup', resume_after=self.resume_token) as stream:
+            if self.resume_token is None:
+                # Anything cached before the stream opened may have changed unseen
+                self.clear_all()
+            self.set_mode('change_stream')
+            for change in stream:
+                self.apply(change)
+                self.resume_token = stream.resume_token
+
+    def apply(self, change):
+        operation = change['operationType']
+        if operation not in ('insert', 'update', 'replace', 'delete'):
+            # drop, rename, dropDatabase, invalidate: the stream ends after these
+            self.clear_all()
+            self.resume_token = None
+            return
+
+        cache, field = TARGETS[change['ns']['coll']]
+        document = change.get('fullDocument') or {}
+        updated = (change.get('updateDescription') or {}).get('updatedFields') or {}
+        if document.get(field) and field not in updated:
+            cache.invalidate(document[field])
+        else:
+            # Deletes only carry the _id, and a renamed key leaves its old name behind
+            cache.clear()
+        self.evictions += 1
+
+    def stats(self):
+        return {"mode": self.mode, "evictions": self.evictions}
+
+cache_invalidator = CacheInvalidator(MongoConnector())
@@ -0,0 +1,197 @@
+"""
+Durable photo processing queue in a local SQLite file (Config.JOBS_DATABASE).
+
+Web workers enqueue jobs and read their status; worker.py processes them.
+Any number of worker processes on the host can share the file: a job is
+claimed in a write transaction and leased for JOB_LEASE_SECONDS, so a job
+whose worker died is picked up again once its lease runs out.
+"""
+import time
+import uuid
+from datetime import datetime, timezone
+from config import Config
+from sqlite_repositories import SQLiteDatabase
+
+PENDING_PREFIX = 'pending:'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    listing_url TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    run_after REAL NOT NULL,
+    locked_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_after);
+CREATE TABLE IF NOT EXISTS job_photos (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data,
+    photo_id TEXT,
+    PRIMARY KEY (job_id, position)
+);
+"""
+
+_database = None
+
+def database():
+    """The queue at Config.JOBS_DATABASE, creating the tables on first use."""
+    global _database
+    if _database is None or _database.path != Config.JOBS_DATABASE:
+        _database = SQLiteDatabase(Config.JOBS_DATABASE, SCHEMA)
+    return _database
+
+def connect():
+    return database().connect()
+
+def transaction():
+    """Concurrent claims serialize on the write lock."""
+    return database().transaction()
+
+def is_pending(ref):
+    return isinstance(ref, str) and ref.startswith(PENDING_PREFIX)
+
+def placeholder(job_id, position):
+    return f'{PENDING_PREFIX}{job_id}:{position}'
+
+class PhotoJob:
+    """
+    Uploads collected while handling a request. Each upload is stood in for
+    by a placeholder in the listing's photo array, which the worker swaps for
+    the stored photo id once it is processed.
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.uploads = []
+
+    def add(self, upload):
+        self.uploads.append(upload)
+        return placeholder(self.id, len(self.uploads) - 1)
+
+    @property
+    def placeholders(self):
+        return [placeholder(self.id, position) for position in range(len(self.uploads))]
+
+    def enqueue(self, listing_url):
+        now = time.time()
+        rows = [
+            (self.id, position, upload if isinstance(upload, (str, bytes)) else _read(upload))
+            for position, upload in enumerate(self.uploads)
+        ]
+        with transaction() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, listing_url, status, max_attempts, total, run_after, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.id, listing_url, 'queued', Config.JOB_MAX_ATTEMPTS, len(rows), now, now, now)
+            )
+            conn.executemany('INSERT INTO job_photos (job_id, position, data) VALUES (?, ?, ?)', rows)
+        return self.id
+
+def _read(upload):
+    upload.seek(0)
+    return upload.read()
+
+def claim_job():
+    """
+    Lease the oldest job that is due, or whose worker's lease ran out, and
+    count the attempt. Returns the job row or None.
+    """
+    now = time.time()
+    with transaction() as conn:
+        job = conn.execute(
+            "SELECT id FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+            "OR (status = 'running' AND locked_until <= ?) ORDER BY created_at LIMIT 1",
+            (now, now)
+        ).fetchone()
+        if job is None:
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ? "
+            "WHERE id = ?",
+            (now + Config.JOB_LEASE_SECONDS, now, job['id'])
+        )
+        return conn.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+
+def pending_photos(job_id):
+    """(position, upload) of the photos of a job that are not stored yet."""
+    return connect().execute(
+        'SELECT position, data FROM job_photos WHERE job_id = ? AND photo_id IS NULL ORDER BY position',
+        (job_id,)
+    ).fetchall()
+
+def unfinished_placeholders(job_id):
+    return [
+        placeholder(job_id, row['position']) for row in connect().execute(
+            'SELECT position FROM job_photos WHERE job_id = ? AND photo_id IS NULL', (job_id,)
+        )
+    ]
+
+def photo_done(job_id, position, photo_id):
+    """Record a stored photo and extend the lease of the job."""
+    now = time.time()
+    with transaction() as conn:
+        conn.execute(
+            'UPDATE job_photos SET photo_id = ?, data = NULL WHERE job_id = ? AND position = ?',
+            (photo_id, job_id, position)
+        )
+        conn.execute(
+            'UPDATE jobs SET processed = processed + 1, locked_until = ?, updated_at = ? WHERE id = ?',
+            (now + Config.JOB_LEASE_SECONDS, now, job_id)
+        )
+
+def finish_job(job_id):
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'done', error = NULL, locked_until = NULL, updated_at = ? WHERE id = ?",
+            (time.time(), job_id)
+        )
+
+def retry_job(job, error):
+    """Queue the job again after an exponential backoff."""
+    now = time.time()
+    delay = Config.JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, locked_until = NULL, updated_at = ? "
+            "WHERE id = ?",
+            (error, now + delay, now, job['id'])
+        )
+    return delay
+
+def fail_job(job_id, error):
+    """Give up on a job and drop the uploads it still holds."""
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, locked_until = NULL, updated_at = ? WHERE id = ?",
+            (error, time.time(), job_id)
+        )
+        conn.execute('UPDATE job_photos SET data = NULL WHERE job_id = ?', (job_id,))
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat() if value else None
+
+def job_status(job_id):
+    """Public view of a job, or None if there is no such job."""
+    job = connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    return {
+        "id": job['id'],
+        "listing_url": job['listing_url'],
+        "status": job['status'],
+        "processed": job['processed'],
+        "total": job['total'],
+        "attempts": job['attempts'],
+        "max_attempts": job['max_attempts'],
+        "error": job['error'],
+        "next_attempt_at": _timestamp(job['run_after']) if job['status'] == 'queued' else None,
+        "created_at": _timestamp(job['created_at']),
+        "updated_at": _timestamp(job['updated_at']),
+    }
@@ -0,0 +1,150 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import g, has_request_context, request
+from config import Config
+
+class DroppingQueueHandler(QueueHandler):
+    """Enqueue without ever blocking the caller; records are dropped when the queue is full."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+class RequestIdFilter(logging.Filter):
+    """Tag records with the id of the request being handled, if any."""
+
+    def filter(self, record):
+        record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per logger name: at most `rate` records per second with
+    bursts of `burst` from each rate-limited logger. Other loggers, and
+    CRITICAL records, always pass.
+    """
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits
+        self.suppressed = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        limit = self.limits.get(record.name)
+        if limit is None or record.levelno >= logging.CRITICAL:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(record.name, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[record.name] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self.suppressed += 1
+        return allowed
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "request_id": getattr(record, 'request_id', '-'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def assign_request_id():
+    """before_request hook: reuse the caller's X-Request-ID or make one up."""
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+def echo_request_id(response):
+    request_id = g.get('request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    return response
+
+SLOW_QUERY_LOGGER = 'lucky_house.slow_queries'
+
+def not_slow_query(record):
+    return not record.name.startswith(SLOW_QUERY_LOGGER)
+
+def configure_logging(config=Config):
+    """
+    Route the lucky_house loggers through a queue. Request threads only
+    filter and enqueue; a listener thread formats and writes to the rotating
+    log file and the console. Forked processes start their own listener.
+    """
+    if not os.path.exists(config.LOG_DIR):
+        os.makedirs(config.LOG_DIR)
+
+    if config.LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+        )
+
+    file_handler = RotatingFileHandler(
+        os.path.join(config.LOG_DIR, 'lucky_house.log'), 
+        maxBytes=10000000,  # 10MB
+        backupCount=5
+    )
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.INFO)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(logging.DEBUG)
+
+    # Slow queries get their own file instead of the main log and console
+    slow_handler = RotatingFileHandler(
+        os.path.join(config.LOG_DIR, 'slow_queries.log'),
+        maxBytes=10000000,
+        backupCount=5
+    )
+    slow_handler.setFormatter(formatter)
+    slow_handler.addFilter(logging.Filter(SLOW_QUERY_LOGGER))
+    file_handler.addFilter(not_slow_query)
+    console_handler.addFilter(not_slow_query)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter({
+        name: (config.LOG_RATE_LIMIT, config.LOG_RATE_BURST) for name in config.LOG_RATE_LIMITED
+    }))
+    queue_handler.addFilter(RequestIdFilter())
+
+    listener = QueueListener(
+        queue_handler.queue, file_handler, console_handler, slow_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_listener():
+        # A forked child inherits the queue but not the thread draining it
+        queue_handler.queue = listener.queue = queue.Queue(config.LOG_QUEUE_SIZE)
+        listener._thread = None
+        listener.start()
+    os.register_at_fork(after_in_child=restart_listener)
+
+    logger = logging.getLogger('lucky_house')
+    logger.addHandler(queue_handler)
+    logger.setLevel(config.LOG_LEVEL)
+    return listener
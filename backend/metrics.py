@@ -0,0 +1,184 @@
+import bisect
+import logging
+import threading
+from pymongo import monitoring
+from config import Config
+
+# Which replica set member served each read, with MONGO_LOG_READS
+reads_logger = logging.getLogger('lucky_house.reads')
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Size buckets in bytes, for compressed photos
+SIZE_BUCKETS = (16e3, 32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6)
+
+_registry = []
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in values
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Histogram:
+    """
+    Prometheus histogram kept in process memory. Observing is a bisect and a
+    few additions under a lock; all formatting is deferred to the scrape.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_labels(names, labelvalues + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+class Counter:
+    """Prometheus counter kept in process memory."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in values:
+            lines.append(f'{self.name}{_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+class Callback:
+    """Metric whose samples are read from elsewhere when scraped, e.g. cache counters."""
+
+    def __init__(self, name, documentation, metric_type, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for labelvalues, value in self.collect():
+            lines.append(f'{self.name}{_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+def render():
+    """All metrics of this process in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Flask request latency.',
+    ('blueprint', 'route', 'method', 'status')
+)
+mongo_command_duration = Histogram(
+    'mongo_command_duration_seconds', 'MongoDB command latency.',
+    ('collection', 'command', 'outcome')
+)
+mongo_reads = Counter(
+    'mongo_reads_total', 'MongoDB reads by the replica set member that served them.',
+    ('member', 'collection', 'read_preference')
+)
+compression_duration = Histogram(
+    'photo_compression_seconds', 'Time to compress one photo, including queueing.'
+)
+compression_size = Histogram(
+    'photo_compression_output_bytes', 'Size of compressed photo renditions.',
+    ('rendition',), SIZE_BUCKETS
+)
+
+READ_COMMANDS = {'find', 'getMore', 'aggregate', 'count', 'distinct'}
+
+def member_address(connection_id):
+    host, port = connection_id
+    return f'{host}:{port}'
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Times every Mongo command by collection and command name, and counts reads
+    by the member that served them. The last read of each thread is kept for
+    checks such as `flask read-routing`.
+    """
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._last_read = threading.local()
+
+    def _key(self, event):
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        collection = collection if isinstance(collection, str) else ''
+        # Drivers only send a read preference that is not primary
+        mode = (event.command.get('$readPreference') or {}).get('mode', 'primary')
+        with self._lock:
+            self._collections[self._key(event)] = (collection, mode)
+
+    def _finished(self, event, outcome):
+        with self._lock:
+            collection, mode = self._collections.pop(self._key(event), ('', 'primary'))
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name, outcome)
+        if outcome == 'ok' and event.command_name in READ_COMMANDS:
+            member = member_address(event.connection_id)
+            mongo_reads.inc(member, collection, mode)
+            self._last_read.value = (member, collection, mode)
+            if Config.MONGO_LOG_READS:
+                reads_logger.debug('%s %s (%s) served by %s', event.command_name, collection, mode, member)
+
+    def last_read(self):
+        """(member, collection, read preference) of this thread's last read, or None."""
+        return getattr(self._last_read, 'value', None)
+
+    def succeeded(self, event):
+        self._finished(event, 'ok')
+
+    def failed(self, event):
+        self._finished(event, 'error')
+
+command_metrics = CommandMetrics()
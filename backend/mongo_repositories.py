@@ -0,0 +1,203 @@
+"""
+Repositories on MongoDB: users, viewers and listings are collections, photos
+live in the "photos" GridFS bucket.
+"""
+from datetime import datetime, timezone
+from io import BytesIO
+import gridfs
+from gridfs.errors import FileExists, NoFile
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from db import MongoConnector, profile_options
+from pagination import keyset_filter
+from repositories import (
+    ANY_VERSION, AccountRepository, DuplicateError, ListingRepository, PhotoNotFound, PhotoRepository
+)
+from search import SORTS, search_page
+
+def _projection(projection):
+    # Repositories never hand out Mongo's _id
+    return {"_id": 0, **(projection or {})}
+
+def _limited(cursor, limit, batch_size):
+    if limit:
+        cursor = cursor.limit(limit)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+class MongoAccounts(AccountRepository):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, username, projection=None):
+        return self.collection.find_one({"username": username}, _projection(projection))
+
+    def insert(self, doc):
+        try:
+            # insert_one would add an _id to the caller's dict
+            self.collection.insert_one(dict(doc))
+        except DuplicateKeyError:
+            raise DuplicateError(doc.get("username"))
+
+    def insert_many(self, docs):
+        if not docs:
+            return {}
+        try:
+            self.collection.bulk_write([InsertOne(dict(doc)) for doc in docs], ordered=False)
+        except BulkWriteError as e:
+            return {
+                error['index']: "Already exists" if error.get('code') == 11000 else error.get('errmsg')
+                for error in e.details.get('writeErrors', [])
+            }
+        return {}
+
+    def update(self, username, fields):
+        return self.collection.update_one({"username": username}, {"$set": fields}).matched_count > 0
+
+    def delete(self, username):
+        return self.collection.delete_one({"username": username}).deleted_count > 0
+
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        query = {"username": {"$gt": after}} if after else {}
+        cursor = self.collection.find(query, _projection(projection)).sort("username", 1)
+        return _limited(cursor, limit, batch_size)
+
+    def by_listing(self, listing_url, projection=None):
+        return list(self.collection.find({"listing_url": listing_url}, _projection(projection)))
+
+class MongoListings(ListingRepository):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, url, projection=None):
+        return self.collection.find_one({"url": url}, _projection(projection))
+
+    def has_photo(self, url, photo_id):
+        return self.collection.find_one({"url": url, "photos": photo_id}, {"_id": 1}) is not None
+
+    def insert(self, doc):
+        try:
+            self.collection.insert_one(dict(doc))
+        except DuplicateKeyError:
+            raise DuplicateError(doc.get("url"))
+
+    def update(self, url, update, version=ANY_VERSION):
+        query = {"url": url}
+        if version is not ANY_VERSION:
+            query["version"] = version
+        return self.collection.update_one(query, update).matched_count > 0
+
+    def delete(self, url):
+        return self.collection.delete_one({"url": url}).deleted_count > 0
+
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        query = {"url": {"$gt": after}} if after else {}
+        cursor = self.collection.find(query, _projection(projection)).sort("url", 1)
+        return _limited(cursor, limit, batch_size)
+
+    def search(self, params, projection):
+        query = dict(params["filter"])
+        if params["text"]:
+            query['$text'] = {'$search': params["text"]}
+        if params["sort"] == 'relevance':
+            score = {'$meta': 'textScore'}
+            cursor = (
+                self.collection.find(query, {**_projection(projection), 'score': score})
+                .sort([('score', score), ('url', 1)])
+                .skip(params["offset"])
+            )
+        else:
+            keys = SORTS[params["sort"]]
+            if params["after"] is not None:
+                query = {'$and': [query, keyset_filter(keys, params["after"])]}
+            cursor = self.collection.find(query, _projection(projection)).sort(keys)
+        return search_page(list(cursor.limit(params["limit"] + 1)), params)
+
+    def replace_photo(self, url, old, new):
+        self.collection.update_one(
+            {"url": url, "photos": old},
+            {
+                "$set": {"photos.$": new, "updated_at": datetime.now(timezone.utc)},
+                "$inc": {"version": 1}
+            }
+        )
+
+    def release_photo_job(self, url, job_id, placeholders=()):
+        update = {"$pull": {"photo_jobs": job_id}}
+        if placeholders:
+            update["$pull"]["photos"] = {"$in": list(placeholders)}
+            update["$inc"] = {"version": 1}
+        self.collection.update_one({"url": url}, update)
+        self.collection.update_one(
+            {"url": url, "status": "processing", "photo_jobs": {"$size": 0}},
+            {"$set": {"status": "ready", "updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}}
+        )
+
+class MongoPhotos(PhotoRepository):
+    def __init__(self, connector, options=None):
+        self.connector = connector
+        self.options = options or {}
+        self.files = connector.get_collection('photos.files', **self.options)
+        self._bucket = None
+
+    def bucket(self):
+        """GridFS bucket on this process's client."""
+        database = self.connector.get_database(**self.options)
+        if self._bucket is None or self._bucket[0] is not database.client:
+            self._bucket = (database.client, gridfs.GridFSBucket(database, bucket_name='photos'))
+        return self._bucket[1]
+
+    def save(self, file_id, data, content_type):
+        if self.files.find_one({"_id": file_id}, {"_id": 1}) is not None:
+            return
+        try:
+            self.bucket().upload_from_stream_with_id(
+                file_id, file_id, BytesIO(data),
+                metadata={"contentType": content_type}
+            )
+        except FileExists:
+            # Another request stored the same bytes first
+            pass
+
+    def set_metadata(self, file_id, renditions=None, upload_sha256=None):
+        metadata = {f"metadata.renditions.{name}": rendition_id for name, rendition_id in (renditions or {}).items()}
+        if upload_sha256:
+            metadata["metadata.upload_sha256"] = upload_sha256
+        if metadata:
+            self.files.update_one({"_id": file_id}, {"$set": metadata})
+
+    def existing(self, file_ids):
+        if not file_ids:
+            return set()
+        return {photo["_id"] for photo in self.files.find({"_id": {"$in": list(file_ids)}}, {"_id": 1})}
+
+    def by_upload_hash(self, hashes):
+        return {
+            photo["metadata"]["upload_sha256"]: photo["_id"]
+            for photo in self.files.find(
+                {"metadata.upload_sha256": {"$in": list(hashes)}},
+                {"metadata.upload_sha256": 1}
+            )
+        }
+
+    def open(self, file_id, size=None):
+        if size and size != 'full':
+            photo = self.files.find_one({"_id": file_id}, {"metadata.renditions": 1})
+            renditions = ((photo or {}).get("metadata") or {}).get("renditions") or {}
+            file_id = renditions.get(size, file_id)
+        try:
+            return self.bucket().open_download_stream(file_id)
+        except NoFile:
+            raise PhotoNotFound(file_id)
+
+class MongoBackend:
+    name = 'mongo'
+
+    def __init__(self, connector=None, profile='primary'):
+        connector = connector or MongoConnector()
+        options = profile_options(profile)
+        self.users = MongoAccounts(connector.get_collection('users', **options))
+        self.viewers = MongoAccounts(connector.get_collection('viewers', **options))
+        self.listings = MongoListings(connector.get_collection('listings', **options))
+        self.photos = MongoPhotos(connector, options)
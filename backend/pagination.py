@@ -0,0 +1,45 @@
+import base64
+import json
+from flask import jsonify, request, url_for
+
+class PageError(ValueError):
+    pass
+
+def page_response(items, next_cursor, cursor_param='after'):
+    """
+    JSON array of items. The cursor of the next page, if any, goes in the
+    X-Next-Cursor header and a Link rel="next" header.
+    """
+    response = jsonify(items)
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args[cursor_param] = next_cursor
+        next_url = url_for(request.endpoint, _external=True, **(request.view_args or {}), **args)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode('ascii')
+
+def decode_cursor(cursor):
+    """The object encode_cursor encoded; PageError for anything else."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeEncodeError):
+        raise PageError('Invalid cursor')
+    if not isinstance(data, dict):
+        raise PageError('Invalid cursor')
+    return data
+
+def keyset_filter(sort, values):
+    """
+    Filter for documents after `values` in a compound sort, e.g. for
+    [(name, 1), (url, 1)]: name > v0, or name == v0 and url > v1.
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = {k: v for (k, _), v in zip(sort[:i], values)}
+        clause[key] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
@@ -0,0 +1,185 @@
+"""
+Check that the storage backends behave alike: run the same repository
+operations against Mongo and a temporary SQLite file, and report every result
+that differs. Exits with status 1 on any difference.
+
+Uses an in-memory Mongo stand-in (mongomock) by default, which lacks text
+search and positional updates; those checks only run against a real mongod
+(in a lucky_house_parity database, dropped first):
+
+    python parity.py
+    python parity.py --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+from db import mongomock_client
+from mongo_repositories import MongoBackend
+from pagination import PageError
+from repositories import DuplicateError, PhotoNotFound
+from routes.listing import DETAILS_PROJECTION, PREVIEW_PROJECTION, VERSION_PROJECTION
+from search import SUMMARY_PROJECTION, parse_search
+from sqlite_repositories import SQLiteBackend
+from werkzeug.datastructures import MultiDict
+
+PARITY_DATABASE = 'lucky_house_parity'
+
+class ParityConnector:
+    """Just enough of MongoConnector for MongoBackend, on a scratch database."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_database(self, **options):
+        return self.client.get_database(PARITY_DATABASE, **options)
+
+    def get_collection(self, name, **options):
+        return self.get_database()[name].with_options(**options)
+
+def mongo_backend(mongo_uri):
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        client.drop_database(PARITY_DATABASE)
+        from indexes import ensure_indexes
+        ensure_indexes(client[PARITY_DATABASE])
+    else:
+        client = mongomock_client()
+        database = client[PARITY_DATABASE]
+        for name in ('users', 'viewers'):
+            database[name].create_index('username', unique=True)
+        database['listings'].create_index('url', unique=True)
+    return MongoBackend(ParityConnector(client))
+
+def normalize(value):
+    """Results as comparable values: times and text scores differ by nature."""
+    if isinstance(value, datetime):
+        return '<datetime>'
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items() if key != 'score'}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, set):
+        return sorted(value)
+    return value
+
+def outcome(check, backend):
+    try:
+        return normalize(check(backend))
+    except (DuplicateError, PhotoNotFound, PageError, ValueError) as e:
+        return f'<{type(e).__name__}>'
+
+def search(backend, projection=SUMMARY_PROJECTION, base_filter=None, **args):
+    """Every page of a search, following the cursors."""
+    pages = []
+    cursor = None
+    while True:
+        query = MultiDict({**args, **({'cursor': cursor} if cursor else {})})
+        docs, cursor = backend.listings.search(parse_search(query, base_filter), projection)
+        pages.append(docs)
+        if cursor is None or len(pages) > 20:
+            return pages
+
+def account(i, listing=None):
+    return {"username": f"user-{i}", "password_hash": f"hash-{i}", "user_type": "tenant",
+            "first_name": "First", "last_name": str(i), "listing_url": listing}
+
+def listing(i, open=True):
+    return {"url": f"listing-{i:02d}", "name": f"Listing {i % 4}", "address": f"{i} Parity Street",
+            "description": ["Sunny loft", "Two bedroom flat", "Garden cottage"][i % 3],
+            "open": open, "version": 1, "photos": [f"photo-{i}-a", f"photo-{i}-b"]}
+
+def text_page(backend, **args):
+    return search(backend, q='cottage garden', **args)
+
+# (name, operation, needs a real mongod); operations run in order on one backend
+CHECKS = [
+    ('insert users', lambda b: [b.users.insert(account(i, f'listing-{i % 3:02d}')) for i in range(6)], False),
+    ('insert duplicate user', lambda b: b.users.insert(account(2)), False),
+    ('insert_many users', lambda b: b.users.insert_many([account(10), account(3), account(11)]), False),
+    ('get user', lambda b: b.users.get('user-3'), False),
+    ('get user projected', lambda b: b.users.get('user-3', {"_id": 0, "password_hash": 0}), False),
+    ('get missing user', lambda b: b.users.get('nobody'), False),
+    ('update user', lambda b: b.users.update('user-4', {"email": "four@example.com", "listing_url": None}), False),
+    ('update missing user', lambda b: b.users.update('nobody', {"email": "x"}), False),
+    ('get updated user', lambda b: b.users.get('user-4'), False),
+    ('list users', lambda b: list(b.users.list()), False),
+    ('list users after, limited', lambda b: list(b.users.list('user-2', 3, {"username": 1, "listing_url": 1})), False),
+    ('users by listing', lambda b: b.users.by_listing('listing-01', {"username": 1, "password_hash": 1}), False),
+    ('delete user', lambda b: b.users.delete('user-5'), False),
+    ('delete missing user', lambda b: b.users.delete('user-5'), False),
+    ('insert viewers', lambda b: b.viewers.insert_many(
+        [{"username": f"viewer-{i}", "password": "pw", "listing_url": "listing-01"} for i in range(3)]), False),
+    ('list viewers', lambda b: list(b.viewers.list(limit=2)), False),
+    ('insert listings', lambda b: [b.listings.insert(listing(i, open=i % 4 != 0)) for i in range(12)], False),
+    ('insert duplicate listing', lambda b: b.listings.insert(listing(3)), False),
+    ('get listing', lambda b: b.listings.get('listing-03', DETAILS_PROJECTION), False),
+    ('get preview', lambda b: b.listings.get('listing-03', PREVIEW_PROJECTION), False),
+    ('get version', lambda b: b.listings.get('listing-03', VERSION_PROJECTION), False),
+    ('get missing listing', lambda b: b.listings.get('listing-99'), False),
+    ('has photo', lambda b: [b.listings.has_photo('listing-03', 'photo-3-b'),
+                             b.listings.has_photo('listing-03', 'photo-4-b'),
+                             b.listings.has_photo('listing-99', 'photo-3-b')], False),
+    ('update listing', lambda b: b.listings.update('listing-03', {
+        "$set": {"name": "Renamed", "status": "processing"}, "$inc": {"version": 1},
+        "$push": {"photos": {"$each": ["pending:job:0", "pending:job:1"]}, "photo_jobs": "job"}}), False),
+    ('pull photos', lambda b: b.listings.update('listing-04', {
+        "$pull": {"photos": {"$in": ["photo-4-a"]}}, "$unset": {"address": ""}}), False),
+    ('update missing listing', lambda b: b.listings.update('listing-99', {"$set": {"name": "x"}}), False),
+    ('update at a version', lambda b: [b.listings.update('listing-05', {"$set": {"name": "Stale"}}, version=2),
+                                       b.listings.update('listing-05', {"$set": {"name": "Fresh"}, "$inc": {"version": 1}}, version=1),
+                                       b.listings.get('listing-05', {"name": 1, "version": 1})], False),
+    ('get updated listings', lambda b: [b.listings.get('listing-03'), b.listings.get('listing-04')], False),
+    ('replace placeholder', lambda b: [b.listings.replace_photo('listing-03', 'pending:job:0', 'photo-new'),
+                                       b.listings.get('listing-03', {"photos": 1, "version": 1})], True),
+    ('release photo job', lambda b: [b.listings.release_photo_job('listing-03', 'job', ['pending:job:1']),
+                                     b.listings.get('listing-03', {"photos": 1, "status": 1, "version": 1})], False),
+    ('list listings', lambda b: list(b.listings.list('listing-05', 4, {"url": 1, "photos": {"$slice": 1}})), False),
+    ('search by url', lambda b: search(b, limit='5'), False),
+    ('search by -url, open', lambda b: search(b, sort='-url', open='true', limit='4'), False),
+    ('search by name', lambda b: search(b, sort='name', limit='3'), False),
+    ('search by -name, closed', lambda b: search(b, sort='-name', open='false'), False),
+    ('viewer search', lambda b: search(b, {"_id": 0, "url": 1, "name": 1}, {"open": True, "url": "listing-01"}), False),
+    ('search bad cursor', lambda b: search(b, sort='name', cursor='bm90IGpzb24'), False),
+    ('text search by relevance', lambda b: text_page(b, limit='2'), True),
+    ('text search by url', lambda b: text_page(b, sort='url', open='true'), True),
+    ('delete listing', lambda b: [b.listings.delete('listing-07'), b.listings.delete('listing-07'),
+                                  b.listings.get('listing-07')], False),
+    ('save photos', lambda b: [b.photos.save('p1', b'full bytes', 'image/jpeg'),
+                               b.photos.save('p1', b'full bytes', 'image/jpeg'),
+                               b.photos.save('p1-thumb', b'thumb', 'image/jpeg'),
+                               b.photos.set_metadata('p1', {"thumb": "p1-thumb"}, 'upload-hash')], False),
+    ('existing photos', lambda b: b.photos.existing(['p1', 'p1-thumb', 'p2']), False),
+    ('photos by upload hash', lambda b: b.photos.by_upload_hash(['upload-hash', 'other']), False),
+    ('open photo', lambda b: [(f._id, f.length, f.metadata["contentType"], f.read())
+                              for f in (b.photos.open('p1'), b.photos.open('p1', 'thumb'),
+                                        b.photos.open('p1', 'medium'))], False),
+    ('open missing photo', lambda b: b.photos.open('p2'), False),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', help='Check against this mongod instead of mongomock')
+    args = parser.parse_args()
+
+    mongo = mongo_backend(args.mongo_uri)
+    sqlite = SQLiteBackend(os.path.join(tempfile.mkdtemp(prefix='parity-'), 'parity.sqlite'))
+    differences = skipped = 0
+    for name, check, needs_mongod in CHECKS:
+        if needs_mongod and not args.mongo_uri:
+            skipped += 1
+            print(f'skip  {name} (needs a real mongod)')
+            continue
+        expected, actual = outcome(check, mongo), outcome(check, sqlite)
+        if expected == actual:
+            print(f'ok    {name}')
+            continue
+        differences += 1
+        print(f'DIFF  {name}\n      mongo:  {expected!r}\n      sqlite: {actual!r}')
+    print(f'{differences} of {len(CHECKS) - skipped} checks differ, {skipped} skipped')
+    sys.exit(1 if differences else 0)
+
+if __name__ == '__main__':
+    main()
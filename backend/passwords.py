@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import jsonify
+from werkzeug.security import check_password_hash, generate_password_hash
+from config import Config
+import logging
+logger = logging.getLogger('lucky_house')
+
+# hashlib's scrypt and pbkdf2 release the GIL, so threads hash in parallel
+_executor = ThreadPoolExecutor(
+    max_workers=Config.PASSWORD_HASH_WORKERS,
+    thread_name_prefix='password-hash'
+)
+# Hashes running plus hashes waiting; anything beyond is turned away
+_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS + Config.PASSWORD_HASH_QUEUE)
+
+class HashingBusy(Exception):
+    """Raised instead of queueing when the hashing pool is saturated."""
+
+def _run(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy('Password hashing queue is full')
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=Config.PASSWORD_HASH_TIMEOUT)
+    except TimeoutError:
+        raise HashingBusy('Password hashing timed out')
+
+def hash_password(password):
+    return _run(generate_password_hash, password, Config.PASSWORD_HASH_METHOD)
+
+def hash_passwords(passwords):
+    """
+    Hash many passwords in parallel for bulk imports. At most
+    PASSWORD_HASH_WORKERS hashes are in flight at once, so interactive logins
+    keep the queue for themselves.
+    """
+    window = threading.BoundedSemaphore(Config.PASSWORD_HASH_WORKERS)
+    futures = []
+    for password in passwords:
+        window.acquire()
+        if not _slots.acquire(timeout=Config.PASSWORD_HASH_TIMEOUT):
+            window.release()
+            raise HashingBusy('Password hashing queue is full')
+        future = _executor.submit(generate_password_hash, password, Config.PASSWORD_HASH_METHOD)
+        future.add_done_callback(lambda _: (_slots.release(), window.release()))
+        futures.append(future)
+    try:
+        return [future.result(timeout=Config.PASSWORD_HASH_TIMEOUT) for future in futures]
+    except TimeoutError:
+        raise HashingBusy('Password hashing timed out')
+
+def check_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+    """True if the hash was made with other parameters than PASSWORD_HASH_METHOD."""
+    return password_hash.split('$', 1)[0] != Config.PASSWORD_HASH_METHOD
+
+def busy_response(e):
+    logger.error('Rejecting request: %s', e)
+    response = jsonify({"message": "Server busy, please try again"})
+    response.headers['Retry-After'] = str(Config.PASSWORD_HASH_RETRY_AFTER)
+    return response, 503
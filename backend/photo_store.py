@@ -0,0 +1,188 @@
+import hashlib
+from io import BytesIO
+from urllib.parse import quote
+from flask import url_for
+from jobs import is_pending
+from repositories import PhotoNotFound, storage
+from uploads import UploadError, check_image
+from utils import compress_images, decode_data_url, is_data_url, read_photo
+import logging
+logger = logging.getLogger('lucky_house')
+
+def photo_id(data):
+    """Photos are content-addressed: the id is the SHA-256 of the stored bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+def save_photo(data, content_type='image/jpeg'):
+    """Store photo bytes once and return their id."""
+    file_id = photo_id(data)
+    storage.photos.save(file_id, data, content_type)
+    return file_id
+
+def save_renditions(renditions, upload_id=None):
+    """
+    Store the output of compress_image and return the id of the full rendition.
+    Smaller renditions and the hash of the original upload are recorded in the
+    full photo's metadata.
+    """
+    file_id = save_photo(renditions['full'])
+    storage.photos.set_metadata(
+        file_id,
+        renditions={name: save_photo(data) for name, data in renditions.items() if name != 'full'},
+        upload_sha256=upload_id
+    )
+    return file_id
+
+def upload_hash(upload):
+    """
+    Hash of an upload: of the base64 text, ignoring its data URL prefix, or of
+    the raw bytes of a file upload, read in chunks.
+    """
+    if isinstance(upload, str):
+        payload = upload.split(',', 1)[1] if ',' in upload else upload
+        return hashlib.sha256(payload.encode('ascii')).hexdigest()
+    digest = hashlib.sha256()
+    upload.seek(0)
+    for chunk in iter(lambda: upload.read(64 * 1024), b''):
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+def store_uploads(uploads):
+    """
+    Compress and store uploads (base64 text or binary files), returning their
+    photo ids in order.
+    Uploads whose original bytes were stored before are not compressed again.
+    """
+    hashes = [upload_hash(upload) for upload in uploads]
+    known = storage.photos.by_upload_hash(hashes)
+    # dict keeps one entry per distinct new upload, in order
+    pending = {h: upload for h, upload in zip(hashes, uploads) if h not in known}
+    for h, renditions in zip(pending, compress_images(list(pending.values()))):
+        known[h] = save_renditions(renditions, upload_id=h)
+    return [known[h] for h in hashes]
+
+def open_photo(file_id, size=None):
+    """
+    Return a seekable file for the photo, or for one of its renditions when
+    size is given. Photos without that rendition return the full photo.
+    Read through the public route, falling back to the primary for photos not
+    replicated yet. Raises repositories.PhotoNotFound.
+    """
+    try:
+        return storage.public.photos.open(file_id, size)
+    except PhotoNotFound:
+        return storage.photos.open(file_id, size)
+
+def photo_url(listing_url, ref, size=None, base_url=None):
+    """
+    Public URL for a photo reference. Legacy embedded data URLs pass through.
+    Outside a Flask request, pass the site's base_url to build it by hand.
+    """
+    if is_data_url(ref):
+        return ref
+    if base_url is None:
+        return url_for('listing.get_listing_photo', url_token=listing_url, photo_id=ref, size=size, _external=True)
+    url = f"{base_url.rstrip('/')}/listing/{quote(listing_url, safe='')}/photos/{ref}"
+    return f"{url}?size={size}" if size else url
+
+def with_photo_urls(listing, base_url=None):
+    """
+    Replace the photo ids of a listing document with their URLs, leaving out
+    photos that a job is still processing.
+    """
+    if listing.get("photos"):
+        listing["photos"] = [
+            photo_url(listing["url"], ref, base_url=base_url)
+            for ref in listing["photos"] if not is_pending(ref)
+        ]
+    return listing
+
+def ref_to_id(ref):
+    """Photo id named by an id or a URL produced by photo_url (not checked)."""
+    return ref.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+def check_new_photo(photo):
+    """
+    A photo sent inline must be a base64 data URL of an image we accept;
+    anything else names no stored photo. Raises UploadError.
+    """
+    if not is_data_url(photo):
+        raise UploadError(f'Unknown photo: {str(photo)[:80]}')
+    check_image(BytesIO(read_photo(photo)))
+
+def resolve_photos(photos, job=None):
+    """
+    Turn a mix of stored photo references and new base64 uploads into photo ids,
+    storing the uploads. Raises UploadError for unknown references and uploads
+    that are not images, before anything is stored or queued.
+    Given a PhotoJob, uploads are added to it and stand as placeholders instead.
+    """
+    candidates = [
+        None if not isinstance(photo, str) or is_data_url(photo) else ref_to_id(photo)
+        for photo in photos
+    ]
+    stored = storage.photos.existing([c for c in candidates if c])
+    photo_ids = [c if c in stored or is_pending(c) else None for c in candidates]
+    for photo, photo_id in zip(photos, photo_ids):
+        if photo_id is None:
+            check_new_photo(photo)
+    if job is not None:
+        return [photo_id or job.add(photo) for photo, photo_id in zip(photos, photo_ids)]
+    uploaded = iter(store_uploads([
+        photo for photo, photo_id in zip(photos, photo_ids) if photo_id is None
+    ]))
+    return [photo_id or next(uploaded) for photo_id in photo_ids]
+
+def data_url_content_type(data_url):
+    header = data_url.split(',', 1)[0]
+    if header.startswith('data:') and ';' in header:
+        return header[len('data:'):header.index(';')] or 'image/jpeg'
+    return 'image/jpeg'
+
+def migrate_embedded_photos(listings_collection, batch_size=50):
+    """
+    Move base64 photos embedded in listing documents into the photo store.
+    Only Mongo deployments predate photo storage, so this takes the Mongo
+    listings collection.
+
+    Listings are converted one at a time in _id order, so an interrupted run can
+    simply be started again: converted listings no longer match the query and
+    re-stored photos dedupe on their content hash.
+    """
+    query = {"photos": {"$regex": "^data:"}}
+    last_id = None
+    migrated = 0
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = list(
+            listings_collection.find(batch_query, {"url": 1, "photos": 1})
+            .sort("_id", 1)
+            .limit(batch_size)
+        )
+        if not batch:
+            break
+
+        for listing in batch:
+            last_id = listing["_id"]
+            try:
+                photo_ids = [
+                    save_photo(decode_data_url(photo), data_url_content_type(photo))
+                    if is_data_url(photo) else photo
+                    for photo in listing["photos"]
+                ]
+            except Exception as e:
+                logger.error('Could not migrate photos for listing %s: %s', listing.get("url"), e)
+                continue
+
+            # Only swap the array if nobody edited the listing in the meantime
+            result = listings_collection.update_one(
+                {"_id": listing["_id"], "photos": listing["photos"]},
+                {"$set": {"photos": photo_ids}, "$inc": {"version": 1}}
+            )
+            migrated += result.modified_count
+
+        logger.info('Migrated photos for %s listings so far', migrated)
+    return migrated
@@ -0,0 +1,274 @@
+"""
+Slow-query log and explain-plan analysis for Mongo commands.
+
+QueryLog listens to every command. Commands slower than MONGO_SLOW_QUERY_MS
+are explained on a background thread (once per query shape and
+QUERY_PLAN_TTL) and written to the lucky_house.slow_queries logger, which
+configure_logging sends to its own file. With MONGO_DIAGNOSTICS every command
+is logged that way at DEBUG level and counted per shape.
+
+explain_report() explains each query shape in QUERY_SHAPES, the queries the
+blueprints issue, and flags those not backed by an index:
+
+    flask --app app query-report
+"""
+import json
+import os
+import queue
+import threading
+import time
+from pymongo import monitoring
+from config import Config
+from metrics import member_address
+import logging
+logger = logging.getLogger('lucky_house')
+slow_logger = logging.getLogger('lucky_house.slow_queries')
+
+# Commands explain accepts, and the field naming their filter
+EXPLAINABLE = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+# Driver and session fields explain does not take
+SESSION_FIELDS = {'lsid', 'txnNumber', '$clusterTime', '$db', '$readPreference', 'readConcern', 'writeConcern'}
+
+def shape_of(value):
+    """A filter with its values blanked out: queries differing only in values share a shape."""
+    if isinstance(value, dict):
+        return {key: shape_of(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        return [shape_of(item) for item in value]
+    return '?'
+
+def command_shape(collection, command_name, command):
+    field = EXPLAINABLE[command_name]
+    query = command.get(field)
+    if command_name in ('update', 'delete'):
+        query = (query or [{}])[0].get('q')
+    parts = [f'{collection}.{command_name}', json.dumps(shape_of(query or {}), sort_keys=True, default=str)]
+    if command.get('sort'):
+        parts.append('sort ' + json.dumps(command['sort'], default=str))
+    return ' '.join(parts)
+
+def explain_body(command_name, command):
+    body = {key: value for key, value in command.items() if key not in SESSION_FIELDS}
+    if command_name in ('update', 'delete'):
+        # explain takes a single statement
+        body[EXPLAINABLE[command_name]] = body[EXPLAINABLE[command_name]][:1]
+    if command_name == 'aggregate':
+        body.pop('cursor', None)
+    return body
+
+def returned_count(command_name, reply):
+    if 'cursor' in reply:
+        return len(reply['cursor'].get('firstBatch', []))
+    if command_name == 'findAndModify':
+        return 1 if reply.get('value') is not None else 0
+    return reply.get('n')
+
+def _find_key(document, key):
+    """First value stored under key anywhere in a nested explain document."""
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        document = list(document.values())
+    if isinstance(document, list):
+        for item in document:
+            found = _find_key(item, key)
+            if found is not None:
+                return found
+    return None
+
+def _plan_stages(plan, stages, indexes):
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    if 'indexName' in plan:
+        indexes.append(plan['indexName'])
+    for key in ('inputStage', 'queryPlan'):
+        _plan_stages(plan.get(key), stages, indexes)
+    for child in plan.get('inputStages', []):
+        _plan_stages(child, stages, indexes)
+
+def summarize_explain(result):
+    """Plan stages, indexes used and documents examined vs returned of an explain result."""
+    stages, indexes = [], []
+    _plan_stages(_find_key(result, 'winningPlan'), stages, indexes)
+    stats = _find_key(result, 'executionStats') or {}
+    return {
+        "stages": stages,
+        "indexes": indexes,
+        "collscan": 'COLLSCAN' in stages,
+        "in_memory_sort": 'SORT' in stages,
+        "docs_examined": stats.get('totalDocsExamined'),
+        "keys_examined": stats.get('totalKeysExamined'),
+        "returned": stats.get('nReturned'),
+    }
+
+def explain(database, command_name, command):
+    return summarize_explain(database.command(
+        {"explain": explain_body(command_name, command), "verbosity": "executionStats"}
+    ))
+
+def describe_plan(plan):
+    if plan is None:
+        return 'plan=unknown'
+    return (f'plan={">".join(reversed(plan["stages"])) or "?"} index={",".join(plan["indexes"]) or "-"} '
+            f'examined={plan["docs_examined"]} keys={plan["keys_examined"]}')
+
+class QueryLog(monitoring.CommandListener):
+    """Times commands and hands slow ones to a background thread that explains them."""
+
+    def __init__(self):
+        self._reset()
+        # A forked child starts with no pending commands and no analyzer thread
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pending = {}
+        self._plans = {}
+        self.shapes = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=1000)
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return Config.MONGO_DIAGNOSTICS or Config.MONGO_SLOW_QUERY_MS > 0
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE and self.enabled:
+            collection = event.command.get(event.command_name)
+            with self._lock:
+                self._pending[(event.connection_id, event.request_id)] = (
+                    event.database_name, collection, event.command
+                )
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        database, collection, command = pending
+        duration_ms = event.duration_micros / 1000
+        slow = 0 < Config.MONGO_SLOW_QUERY_MS <= duration_ms
+        if not (slow or Config.MONGO_DIAGNOSTICS):
+            # Fast commands cost nothing more without diagnostics
+            return
+        shape = command_shape(collection, event.command_name, command)
+        if Config.MONGO_DIAGNOSTICS:
+            self._count(shape, duration_ms)
+        returned = returned_count(event.command_name, event.reply)
+        self._submit((
+            database, event.command_name, command, shape, duration_ms, returned, slow,
+            member_address(event.connection_id)
+        ))
+
+    def failed(self, event):
+        with self._lock:
+            self._pending.pop((event.connection_id, event.request_id), None)
+
+    def _count(self, shape, duration_ms):
+        with self._lock:
+            stats = self.shapes.setdefault(shape, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+
+    def _submit(self, item):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._analyze, name='query-log', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+    def plan(self, database, command_name, command, shape):
+        """Cached explain summary of a shape, refreshed after QUERY_PLAN_TTL seconds."""
+        cached = self._plans.get(shape)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        from db import MongoConnector
+        plan = explain(MongoConnector().client[database], command_name, command)
+        self._plans[shape] = (plan, time.monotonic() + Config.QUERY_PLAN_TTL)
+        with self._lock:
+            if shape in self.shapes:
+                self.shapes[shape]["plan"] = plan
+        return plan
+
+    def _analyze(self):
+        while True:
+            database, command_name, command, shape, duration_ms, returned, slow, member = self._queue.get()
+            try:
+                plan = self.plan(database, command_name, command, shape)
+            except Exception as e:
+                logger.error('Could not explain %s: %s', shape, e)
+                plan = None
+            slow_logger.log(
+                logging.WARNING if slow else logging.DEBUG,
+                '%s %s %.1fms returned=%s member=%s %s',
+                'SLOW' if slow else 'query', shape, duration_ms, returned, member, describe_plan(plan)
+            )
+
+query_log = QueryLog()
+
+# One entry per query the blueprints issue: (where, collection, command).
+# Values are samples; only the shape matters to the planner.
+QUERY_SHAPES = [
+    ('load_user / login / admin user get, update, delete', 'users',
+     {'find': 'users', 'filter': {'username': 'x'}, 'limit': 1}),
+    ('admin user list', 'users',
+     {'find': 'users', 'filter': {'username': {'$gt': 'x'}}, 'sort': {'username': 1}, 'limit': 101}),
+    ('get_credentials', 'users',
+     {'find': 'users', 'filter': {'listing_url': 'x'}, 'projection': {'username': 1, 'password': 1, '_id': 0}}),
+    ('admin viewer get, update, delete', 'viewers',
+     {'find': 'viewers', 'filter': {'username': 'x'}, 'limit': 1}),
+    ('admin viewer list', 'viewers',
+     {'find': 'viewers', 'filter': {'username': {'$gt': 'x'}}, 'sort': {'username': 1}, 'limit': 101}),
+    ('public preview / details / photo / admin listing update', 'listings',
+     {'find': 'listings', 'filter': {'url': 'x'}, 'limit': 1}),
+    ('listing photo ownership check', 'listings',
+     {'find': 'listings', 'filter': {'url': 'x', 'photos': 'x'}, 'projection': {'_id': 1}, 'limit': 1}),
+    ('admin listing list', 'listings',
+     {'find': 'listings', 'filter': {'url': {'$gt': 'x'}}, 'sort': {'url': 1}, 'limit': 101}),
+    ('listing search by url', 'listings',
+     {'find': 'listings', 'filter': {'open': True}, 'sort': {'url': 1}, 'limit': 101}),
+    ('listing search by name', 'listings',
+     {'find': 'listings', 'filter': {'$and': [{'open': True}, {'$or': [
+         {'name': {'$gt': 'x'}}, {'name': 'x', 'url': {'$gt': 'x'}}]}]},
+      'sort': {'name': 1, 'url': 1}, 'limit': 101}),
+    ('listing text search', 'listings',
+     {'find': 'listings', 'filter': {'$text': {'$search': 'x'}},
+      'projection': {'score': {'$meta': 'textScore'}}, 'sort': {'score': {'$meta': 'textScore'}, 'url': 1},
+      'limit': 101}),
+    ('listing update / photo jobs', 'listings',
+     {'update': 'listings', 'updates': [{'q': {'url': 'x'}, 'u': {'$inc': {'version': 1}}}]}),
+    ('listing delete', 'listings',
+     {'delete': 'listings', 'deletes': [{'q': {'url': 'x'}, 'limit': 1}]}),
+    ('photo dedupe by upload hash', 'photos.files',
+     {'find': 'photos.files', 'filter': {'metadata.upload_sha256': {'$in': ['x']}}}),
+    ('photo lookup by id', 'photos.files',
+     {'find': 'photos.files', 'filter': {'_id': {'$in': ['x']}}, 'projection': {'_id': 1}}),
+]
+
+# Relevance order comes from each query's text scores, which no index holds
+UNINDEXED_SORTS = {'listing text search'}
+
+def explain_report(database):
+    """Explain every entry of QUERY_SHAPES; returns (where, collection, plan or error) rows."""
+    rows = []
+    for where, collection, command in QUERY_SHAPES:
+        command_name = next(iter(command))
+        try:
+            rows.append((where, collection, explain(database, command_name, command)))
+        except Exception as e:
+            rows.append((where, collection, {"error": str(e)}))
+    return rows
@@ -0,0 +1,156 @@
+"""
+Token-bucket rate limits per client IP and per username, and a cap on the
+requests a worker handles at once.
+
+Buckets live in this process by default (RATE_LIMIT_STORAGE=memory), so each
+worker enforces its own share of a limit. RATE_LIMIT_STORAGE=mongo keeps them
+in the rate_limits collection instead, shared by every worker and host.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+from pymongo import ReturnDocument
+from config import Config
+from db import MongoConnector
+import logging
+logger = logging.getLogger('lucky_house')
+# Rate limited itself (LOG_RATE_LIMITED): floods are when it logs the most
+limit_logger = logging.getLogger('lucky_house.ratelimit')
+
+class MemoryBuckets:
+    """Buckets as (tokens, last refill) tuples, dropping the least recently used past maxsize."""
+    shared = False
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token; returns 0 if allowed, else the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.maxsize:
+                # A forgotten bucket is a full one: this only ever errs on allowing
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+class MongoBuckets:
+    """
+    Buckets shared through Mongo. Each take is one atomic pipeline update
+    timed by the server's clock; idle buckets expire through a TTL index.
+    """
+    shared = True
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def take(self, key, rate, burst):
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]}, 1000]}
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]},
+                    "updated": "$$NOW",
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {
+                    "tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    # Refilled completely by then, so forgetting it changes nothing
+                    "expires_at": {"$add": ["$$NOW", math.ceil(burst / rate * 1000)]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return 0 if bucket["allowed"] else (1 - bucket["tokens"]) / rate
+
+def make_buckets():
+    if Config.RATE_LIMIT_STORAGE == 'mongo':
+        return MongoBuckets(MongoConnector().get_collection('rate_limits'))
+    return MemoryBuckets(Config.RATE_LIMIT_MAX_KEYS)
+
+class RateLimiter:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.limited = {}
+        self._lock = threading.Lock()
+
+    def check(self, endpoint, keys):
+        """
+        Take a token from the bucket of each scope ('ip', 'username') that has a
+        limit for endpoint. Returns the seconds to wait if one is empty, else 0.
+        Storage errors let the request through.
+        """
+        limits = Config.RATE_LIMITS.get(endpoint, {})
+        for scope, key in keys.items():
+            if scope not in limits or not key:
+                continue
+            rate, burst = limits[scope]
+            try:
+                wait = self.buckets.take(f'{endpoint}:{scope}:{key}', rate, burst)
+            except Exception as e:
+                logger.error('Rate limit storage failed, allowing request: %s', e)
+                return 0
+            if wait:
+                with self._lock:
+                    self.limited[(endpoint, scope)] = self.limited.get((endpoint, scope), 0) + 1
+                return wait
+        return 0
+
+    def limited_counts(self):
+        with self._lock:
+            return list(self.limited.items())
+
+rate_limiter = RateLimiter(make_buckets())
+
+# Requests being handled by this process; beyond the cap they are refused at once
+_request_slots = threading.BoundedSemaphore(max(Config.MAX_CONCURRENT_REQUESTS, 1))
+shed_requests = 0
+
+def request_keys(endpoint):
+    keys = {'ip': request.remote_addr}
+    if 'username' in Config.RATE_LIMITS.get(endpoint, {}):
+        username = (request.get_json(silent=True) or {}).get('username')
+        keys['username'] = str(username) if username else None
+    return keys
+
+def retry_response(message, wait, status):
+    response = jsonify({"message": message})
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response, status
+
+def rate_limit():
+    """before_request hook: 429 once a client has used up its tokens for the endpoint."""
+    if request.endpoint not in Config.RATE_LIMITS:
+        return None
+    keys = request_keys(request.endpoint)
+    wait = rate_limiter.check(request.endpoint, keys)
+    if wait:
+        limit_logger.error('Rate limited %s %s', request.endpoint, keys)
+        return retry_response("Too many requests", wait, 429)
+    return None
+
+def shed_load():
+    """before_request hook: 503 when MAX_CONCURRENT_REQUESTS are already in progress."""
+    global shed_requests
+    if Config.MAX_CONCURRENT_REQUESTS <= 0 or request.endpoint in Config.SHED_EXEMPT:
+        return None
+    if not _request_slots.acquire(blocking=False):
+        shed_requests += 1
+        limit_logger.error('Shedding %s: %s requests in progress', request.path, Config.MAX_CONCURRENT_REQUESTS)
+        return retry_response("Server busy, please try again", Config.SHED_RETRY_AFTER, 503)
+    g.request_slot = True
+    return None
+
+def release_slot(exc=None):
+    """teardown_request hook; runs after streamed responses finish too."""
+    if g.pop('request_slot', False):
+        _request_slots.release()
@@ -0,0 +1,209 @@
+"""
+Storage interface of the app: repositories for users, viewers, listings and
+photos. Routes only talk to `storage`, which builds the backend named by
+Config.STORAGE_BACKEND on first use:
+
+    mongo   MongoDB through pymongo and GridFS (mongo_repositories.py)
+    sqlite  an embedded SQLite file in WAL mode (sqlite_repositories.py)
+
+Documents are plain dicts shaped like the Mongo documents, without _id.
+Projections take the Mongo forms the routes use: {"field": 1},
+{"field": 0} and {"field": {"$slice": n}}.
+"""
+import threading
+from abc import ABC, abstractmethod
+from config import Config
+
+class DuplicateError(Exception):
+    """The username or url of a new document is taken."""
+
+class PhotoNotFound(Exception):
+    pass
+
+class AccountRepository(ABC):
+    """Users or viewers, keyed by their unique username."""
+
+    @abstractmethod
+    def get(self, username, projection=None):
+        pass
+
+    @abstractmethod
+    def insert(self, doc):
+        """Raises DuplicateError."""
+
+    @abstractmethod
+    def insert_many(self, docs):
+        """Insert what can be inserted; returns {index: error message} for the rest."""
+
+    @abstractmethod
+    def update(self, username, fields):
+        """Set fields on an account; returns whether it exists."""
+
+    @abstractmethod
+    def delete(self, username):
+        """Returns whether an account was deleted."""
+
+    @abstractmethod
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        """Iterate accounts in username order, starting after `after`."""
+
+    @abstractmethod
+    def by_listing(self, listing_url, projection=None):
+        pass
+
+# Default of update(version=...): None names listings that predate versioning
+ANY_VERSION = object()
+
+class ListingRepository(ABC):
+    """Listings, keyed by their unique url."""
+
+    @abstractmethod
+    def get(self, url, projection=None):
+        pass
+
+    @abstractmethod
+    def has_photo(self, url, photo_id):
+        pass
+
+    @abstractmethod
+    def insert(self, doc):
+        """Raises DuplicateError."""
+
+    @abstractmethod
+    def update(self, url, update, version=ANY_VERSION):
+        """
+        Apply an update document using $set, $unset, $inc, $push (with $each)
+        and $pull (with $in) on top-level fields. Given a version, only while
+        the listing is still at that version. Returns whether it was updated.
+        """
+
+    @abstractmethod
+    def delete(self, url):
+        """Returns whether a listing was deleted."""
+
+    @abstractmethod
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        """Iterate listings in url order, starting after `after`."""
+
+    @abstractmethod
+    def search(self, params, projection):
+        """
+        Run a search parsed by search.parse_search. Its filter holds equality
+        filters on open and url. Returns the page and the next cursor.
+        """
+
+    @abstractmethod
+    def replace_photo(self, url, old, new):
+        """Swap one photo reference for another wherever it now is in the listing."""
+
+    @abstractmethod
+    def release_photo_job(self, url, job_id, placeholders=()):
+        """
+        Detach a photo job from its listing, dropping any placeholders it
+        leaves behind. The listing is ready again once no job holds it.
+        """
+
+class PhotoRepository(ABC):
+    """Content-addressed photo bytes with their rendition and upload-hash metadata."""
+
+    @abstractmethod
+    def save(self, file_id, data, content_type):
+        """Store bytes under file_id unless already stored."""
+
+    @abstractmethod
+    def set_metadata(self, file_id, renditions=None, upload_sha256=None):
+        pass
+
+    @abstractmethod
+    def existing(self, file_ids):
+        """The subset of file_ids that are stored."""
+
+    @abstractmethod
+    def by_upload_hash(self, hashes):
+        """{upload hash: file id} for uploads stored before."""
+
+    @abstractmethod
+    def open(self, file_id, size=None):
+        """
+        Seekable file of the photo, or of a rendition, with _id, length,
+        upload_date and metadata attributes. Raises PhotoNotFound.
+        """
+
+def make_backend(name=None, profile='primary'):
+    name = name or Config.STORAGE_BACKEND
+    if name == 'sqlite':
+        from sqlite_repositories import SQLiteBackend
+        return SQLiteBackend(Config.SQLITE_DATABASE)
+    if name == 'mongo':
+        from mongo_repositories import MongoBackend
+        return MongoBackend(profile=profile)
+    raise ValueError(f'Unknown storage backend: {name}')
+
+class Storage:
+    """
+    The repositories of the configured backend, built on first use. Mongo
+    routes them by profile (db.profile_options): `storage.users` and the
+    like read from the primary, `storage.public` may read from secondaries
+    and `storage.bulk` writes with the bulk write concern. A single SQLite
+    file serves every profile alike.
+    """
+
+    def __init__(self):
+        self._backends = {}
+        self._default = 'primary'
+        self._lock = threading.RLock()
+
+    def profile(self, profile):
+        backend = self._backends.get(profile)
+        if backend is None:
+            with self._lock:
+                if profile not in self._backends:
+                    if profile != 'primary' and Config.STORAGE_BACKEND != 'mongo':
+                        self._backends[profile] = self.profile('primary')
+                    else:
+                        self._backends[profile] = make_backend(profile=profile)
+                backend = self._backends[profile]
+        return backend
+
+    def use(self, backend):
+        """Serve every profile from backend, e.g. to run the same workload against both."""
+        with self._lock:
+            self._backends = {'primary': backend, 'public': backend, 'bulk': backend}
+
+    def use_profile(self, profile):
+        """Route this process's default repositories, e.g. a worker doing only background writes."""
+        self._default = profile
+
+    @property
+    def backend(self):
+        return self.profile(self._default)
+
+    @property
+    def public(self):
+        return self.profile('public')
+
+    @property
+    def bulk(self):
+        return self.profile('bulk')
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    @property
+    def users(self):
+        return self.backend.users
+
+    @property
+    def viewers(self):
+        return self.backend.viewers
+
+    @property
+    def listings(self):
+        return self.backend.listings
+
+    @property
+    def photos(self):
+        return self.backend.photos
+
+storage = Storage()
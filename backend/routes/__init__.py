@@ -1,4 +1,7 @@
-from flask import Flask, jsonify, request
+import threading
+import time
+import click
+from flask import Flask, Response, current_app, g, jsonify, request
 from flask_cors import CORS
 from config import Config
 from routes.auth import bp as auth_bp
@@ -10,67 +13,230 @@ import os, sys
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
-from db import MongoConnector
-from user import User, Viewer
+from db import MongoConnector, profile_options
+from repositories import storage
+from user import Viewer, user_from_document
+from cache import preview_cache, user_cache, MISSING
+from photo_store import migrate_embedded_photos
+from indexes import ensure_indexes
+from querylog import QUERY_SHAPES, UNINDEXED_SORTS, describe_plan, explain_report
+from uploads import UploadRequest
+from invalidation import cache_invalidator
+import ratelimit
+from werkzeug.middleware.proxy_fix import ProxyFix
+import metrics
+from logging_setup import assign_request_id, echo_request_id
 
 import logging
 logger = logging.getLogger('lucky_house')
+auth_logger = logging.getLogger('lucky_house.auth')
 
-app = Flask(__name__)
-app.config.from_object(Config)
+# Nothing here connects to Mongo: each process opens its client on first use
 mongoConnector = MongoConnector()
 login_manager = LoginManager()
 login_manager.anonymous_user = Viewer
-login_manager.init_app(app)
-
-CORS(app, 
-     resources={r"/*": {
-         "origins": "*",
-         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-         "allow_headers": ["Content-Type", "Authorization"],
-         "expose_headers": ["Content-Type"],
-         "supports_credentials": True,
-         "send_wildcard": False,
-         "max_age": 86400
-     }})
 
 # Add OPTIONS handler for preflight requests
-@app.before_request
 def handle_preflight():
     if request.method == "OPTIONS":
-        response = app.make_default_options_response()
+        response = current_app.make_default_options_response()
         return response
 
+def health():
+    """Liveness check that never waits on Mongo."""
+    return jsonify({
+        "status": "ok",
+        "storage": Config.STORAGE_BACKEND,
+        "mongo_connected": mongoConnector.connected,
+        "mongo_pool": mongoConnector.pool_stats.snapshot(),
+        "mongo_members": mongoConnector.members(),
+        "cache_invalidation": cache_invalidator.stats()
+    }), 200
+
+def start_timer():
+    g.request_started = time.perf_counter()
+
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.request_duration.observe(
+            time.perf_counter() - started,
+            request.blueprint or '',
+            request.url_rule.rule if request.url_rule else 'unmatched',
+            request.method,
+            str(response.status_code)
+        )
+    return response
+
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def collect_cache_stats(counter):
+    caches = {'user': user_cache, 'preview': preview_cache}
+    return [((name,), cache.stats()[counter]) for name, cache in caches.items()]
+
+metrics.Callback('cache_hits_total', 'In-process cache hits.', 'counter', ('cache',),
+                 lambda: collect_cache_stats('hits'))
+metrics.Callback('cache_misses_total', 'In-process cache misses.', 'counter', ('cache',),
+                 lambda: collect_cache_stats('misses'))
+metrics.Callback('cache_invalidations_total', 'Cache evictions caused by change stream events.', 'counter', (),
+                 lambda: [((), cache_invalidator.evictions)])
+metrics.Callback('rate_limited_requests_total', 'Requests refused with 429.', 'counter', ('endpoint', 'scope'),
+                 ratelimit.rate_limiter.limited_counts)
+metrics.Callback('shed_requests_total', 'Requests refused with 503 over MAX_CONCURRENT_REQUESTS.', 'counter', (),
+                 lambda: [((), ratelimit.shed_requests)])
+metrics.Callback('mongo_pool_connections', 'Mongo connections by state.', 'gauge', ('state',),
+                 lambda: [((state,), mongoConnector.pool_stats.snapshot()[state])
+                          for state in ('open', 'checked_out', 'available')])
+
 @login_manager.user_loader
 def load_user(username):
-    logger.info(f'load_user called with username: {username}')
-    collection = mongoConnector.get_collection('users')
+    cached = user_cache.get(username)
+    if cached is not MISSING:
+        return cached
+
+    auth_logger.debug('load_user called with username: %s', username)
     try:
-        user = collection.find_one({'username': username})
+        user = storage.users.get(username)
         if not user:
-            logger.error(f'No user found with username {username}')
+            auth_logger.error('No user found with username %s', username)
             return None
-        logger.info(f'Loaded user with username {username} and type {user["user_type"]}')
-        return User(
-            username=user['username'],
-            pw=user['password_hash'],
-            user_type=user['user_type'],
-            first_name=user.get('first_name'),
-            last_name=user.get('last_name'),
-            email=user.get('email'),
-            phone=user.get('phone'),
-            listing_url=user.get('listing_url')
-        )
+        auth_logger.debug('Loaded user with username %s and type %s', username, user["user_type"])
+        loaded = user_from_document(user)
+        user_cache.set(username, loaded)
+        return loaded
     except Exception as e:
-        logger.error(f'An error occurred in load_user: {e}')
+        logger.error('An error occurred in load_user: %s', e)
         return None
 
 @login_manager.unauthorized_handler
 def unauthorized():
-    logger.error('Unauthorized access')
+    auth_logger.error('Unauthorized access')
     return jsonify({"error": "Unauthorized"}), 401
 
-# Register Blueprints
-app.register_blueprint(auth_bp, url_prefix="/auth")
-app.register_blueprint(admin_bp, url_prefix="/admin")
-app.register_blueprint(listing_bp, url_prefix="/listing")
\ No newline at end of file
+def bootstrap_indexes():
+    try:
+        ensure_indexes(mongoConnector.get_database())
+    except Exception as e:
+        logger.error('Index bootstrap failed: %s', e)
+
+_index_bootstrap_lock = threading.Lock()
+_index_bootstrap_started = False
+
+def start_index_bootstrap():
+    """before_request hook: create missing indexes once per process, in the background."""
+    global _index_bootstrap_started
+    if _index_bootstrap_started:
+        return
+    with _index_bootstrap_lock:
+        if _index_bootstrap_started:
+            return
+        _index_bootstrap_started = True
+    # Startup never blocks on DNS/TLS, and no request waits on the indexes
+    threading.Thread(target=bootstrap_indexes, name='index-bootstrap', daemon=True).start()
+
+def register_commands(app):
+    @app.cli.command("migrate-photos")
+    @click.option("--batch-size", default=50, show_default=True, help="Listings to load per batch.")
+    def migrate_photos_command(batch_size):
+        """Move embedded base64 listing photos into the photo store. Safe to re-run."""
+        if Config.STORAGE_BACKEND != 'mongo':
+            raise click.ClickException('Embedded photos only ever existed in Mongo listings')
+        storage.use_profile('bulk')
+        migrated = migrate_embedded_photos(
+            mongoConnector.get_collection('listings', **profile_options('bulk')), batch_size
+        )
+        click.echo(f'Migrated photos for {migrated} listings')
+
+    @app.cli.command("query-report")
+    @click.option("--strict", is_flag=True, help="Exit with status 1 if any query is flagged.")
+    def query_report_command(strict):
+        """Explain every query shape the routes use and flag those without an index or sorting in memory."""
+        flagged = 0
+        for where, collection, plan in explain_report(mongoConnector.get_database()):
+            if "error" in plan:
+                flagged += 1
+                click.echo(f'ERROR     {collection:<13} {where}: {plan["error"]}')
+                continue
+            sorts = plan["in_memory_sort"] and where not in UNINDEXED_SORTS
+            status = 'COLLSCAN' if plan["collscan"] else 'SORT' if sorts else 'ok'
+            flagged += plan["collscan"] or sorts
+            click.echo(f'{status:<9} {collection:<13} {where}: {describe_plan(plan)}')
+        click.echo(f'{flagged} of {len(QUERY_SHAPES)} query shapes are not index-backed or could not be explained')
+        if strict and flagged:
+            raise SystemExit(1)
+
+    @app.cli.command("read-routing")
+    @click.option("--reads", default=10, show_default=True, help="Reads per routing profile.")
+    def read_routing_command(reads):
+        """Read a listing through each routing profile and show which members served the reads."""
+        if Config.STORAGE_BACKEND != 'mongo':
+            raise click.ClickException('Read routing only applies to Mongo')
+        for profile in ('primary', 'public'):
+            served = {}
+            for _ in range(reads):
+                # Whether or not the listing exists, a member answers the query
+                storage.profile(profile).listings.get('read-routing-check', {"url": 1})
+                member, _, mode = metrics.command_metrics.last_read()
+                served[(member, mode)] = served.get((member, mode), 0) + 1
+            for (member, mode), count in sorted(served.items()):
+                click.echo(f'{profile:<8} {mode:<19} {member:<22} {count} reads')
+        for member, server_type in sorted(mongoConnector.members().items()):
+            click.echo(f'member   {member:<22} {server_type}')
+
+    @app.cli.command("ensure-indexes")
+    def ensure_indexes_command():
+        """Create the indexes the routes rely on. Safe to re-run."""
+        for collection, names in ensure_indexes(mongoConnector.get_database()).items():
+            click.echo(f'{collection}: {", ".join(names)}')
+
+def create_app(config=Config):
+    """
+    Build the Flask app. Safe to call in a gunicorn master before forking:
+    Mongo is only contacted by the workers, on their first query.
+    """
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+    if config.PROXY_COUNT:
+        # remote_addr (and so per-IP rate limits) then names the client, not the proxy
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.PROXY_COUNT, x_proto=config.PROXY_COUNT)
+    app.config.from_object(config)
+    login_manager.init_app(app)
+
+    CORS(app, 
+         resources={r"/*": {
+             "origins": "*",
+             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"],
+             "expose_headers": ["Content-Type", "Link", "X-Next-Cursor", "X-Request-ID"],
+             "supports_credentials": True,
+             "send_wildcard": False,
+             "max_age": 86400
+         }})
+
+    if config.CACHE_INVALIDATION:
+        # Per worker process, on its first request
+        app.before_request(cache_invalidator.ensure_started)
+    if config.ENSURE_INDEXES and config.STORAGE_BACKEND == 'mongo':
+        # Likewise, so a gunicorn master never opens a client before forking
+        app.before_request(start_index_bootstrap)
+    app.before_request(assign_request_id)
+    app.before_request(start_timer)
+    app.before_request(handle_preflight)
+    # Refuse early rather than queue until the client times out
+    app.before_request(ratelimit.shed_load)
+    app.teardown_request(ratelimit.release_slot)
+    if config.RATE_LIMIT_ENABLED:
+        app.before_request(ratelimit.rate_limit)
+    app.after_request(record_request)
+    app.after_request(echo_request_id)
+    app.add_url_rule("/health", "health", health, methods=["GET"])
+    if config.METRICS_ENABLED:
+        app.add_url_rule("/metrics", "metrics", metrics_endpoint, methods=["GET"])
+
+    # Register Blueprints
+    app.register_blueprint(auth_bp, url_prefix="/auth")
+    app.register_blueprint(admin_bp, url_prefix="/admin")
+    app.register_blueprint(listing_bp, url_prefix="/listing")
+    register_commands(app)
+    return app
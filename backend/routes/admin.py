@@ -1,25 +1,126 @@
-from flask import Blueprint, request, jsonify
+import csv
+from datetime import datetime, timezone
+import io
+import uuid
+from itertools import chain, islice
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from flask_login import login_required, current_user
-from werkzeug.security import (
-    generate_password_hash
-)
 import os, sys
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
-from db import MongoConnector
-from utils import compress_image
+from config import Config
+from werkzeug.exceptions import RequestEntityTooLarge
+from repositories import DuplicateError, storage
+from cache import preview_cache, user_cache
+from passwords import HashingBusy, busy_response, hash_password, hash_passwords
+from photo_store import ref_to_id, resolve_photos, store_uploads, with_photo_urls
+from jobs import PhotoJob, is_pending, job_status
+from utils import generate_viewer_credentials
+from pagination import PageError, page_response
+from search import search_listings
+from uploads import UploadError, uploaded_photos
 import logging
 logger = logging.getLogger('lucky_house')
+auth_logger = logging.getLogger('lucky_house.auth')
 
-mongoClient = MongoConnector()
 bp = Blueprint('admin', __name__)
 
 user_types = ['admin', 'viewer', 'tenant']
 
-users_collection = mongoClient.get_collection('users')
-viewers_collection = mongoClient.get_collection('viewers')
-listings_collection = mongoClient.get_collection('listings')
+# Fields the admin list endpoints may project, keyed by repository
+user_fields = ['username', 'user_type', 'first_name', 'last_name', 'email', 'phone', 'listing_url']
+viewer_fields = ['username', 'password', 'listing_url']
+listing_fields = ['url', 'name', 'address', 'description', 'photos', 'open']
+
+def get_projection(allowed_fields, key, default):
+    """
+    Build a projection from ?fields=a,b,c. An array field can be sliced with
+    name:N, e.g. fields=url,name,photos:1 returns only the first photo.
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+
+    projection = {"_id": 0, key: 1}
+    for field in fields.split(','):
+        name, _, count = field.strip().partition(':')
+        if name not in allowed_fields:
+            raise PageError(f'Unknown field: {name}')
+        if count:
+            if not count.isdigit():
+                raise PageError(f'Invalid slice for field: {name}')
+            projection[name] = {"$slice": int(count)}
+        else:
+            projection[name] = 1
+    return projection
+
+def paginate(repository, key, projection):
+    """
+    Keyset pagination over a unique, indexed key: ?after=<key>&limit=N.
+    Returns the page and the cursor for the next one (None on the last page).
+    Callers asking for neither get every document, as before pagination.
+    """
+    if 'limit' not in request.args and 'after' not in request.args:
+        return list(repository.list(projection=projection)), None
+    limit = request.args.get('limit', Config.ADMIN_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, Config.ADMIN_MAX_PAGE_SIZE))
+
+    # Fetch one extra document to know whether another page exists
+    docs = list(repository.list(request.args.get('after'), limit + 1, projection))
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = docs[-1][key]
+    return docs, next_cursor
+
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def wants_stream():
+    return request.args.get('stream') == '1' or wants_ndjson()
+
+def stream_response(repository, projection, transform=None):
+    """
+    Stream documents straight off the cursor, encoding one at a time, as
+    NDJSON (Accept: application/x-ndjson) or as a JSON array (?stream=1).
+    Streams start at ?after and are only capped when ?limit is given.
+    """
+    ndjson = wants_ndjson()
+    cursor = repository.list(
+        request.args.get('after'), request.args.get('limit', type=int), projection,
+        batch_size=Config.ADMIN_STREAM_BATCH_SIZE
+    )
+
+    def generate():
+        try:
+            if not ndjson:
+                yield '['
+            for i, doc in enumerate(cursor):
+                encoded = current_app.json.dumps(transform(doc) if transform else doc)
+                if ndjson:
+                    yield encoded + '\n'
+                else:
+                    yield encoded if i == 0 else ',' + encoded
+            if not ndjson:
+                yield ']'
+        except Exception as e:
+            # Headers are already sent; the client sees a truncated body
+            logger.error('An error occurred while streaming %s: %s', request.path, e)
+        finally:
+            cursor.close()
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def list_response(repository, key, projection, transform=None):
+    """Respond with a stream or a page of documents, as the client asked."""
+    if wants_stream():
+        return stream_response(repository, projection, transform)
+    docs, next_cursor = paginate(repository, key, projection)
+    if transform:
+        docs = [transform(doc) for doc in docs]
+    return page_response(docs, next_cursor)
 
 @bp.before_request
 def check_admin():
@@ -27,17 +128,85 @@ def check_admin():
     if request.method == 'OPTIONS':
         return jsonify({"message": "OK"}), 200
         
-    logger.info(f'check_admin called. current_user: {current_user}, authenticated: {current_user.is_authenticated}')
+    auth_logger.debug('check_admin called. current_user: %s, authenticated: %s', current_user, current_user.is_authenticated)
     if not current_user.is_authenticated:
-        logger.error('Unauthorized access: user not authenticated')
+        auth_logger.error('Unauthorized access: user not authenticated')
         return jsonify({"error": "Unauthorized"}), 401
     
-    logger.info(f'User type: {current_user.user_type}')
     if current_user.user_type != 'admin':
-        logger.error('Unauthorized access: user is not admin')
+        auth_logger.error('Unauthorized access: user %s is not admin', current_user.username)
         return jsonify({"error": "Unauthorized"}), 403
     
-    logger.info('Admin access granted')
+    auth_logger.debug('Admin access granted to %s', current_user.username)
+
+def iter_bulk_rows():
+    """Rows of a bulk request: a JSON array, or a CSV body parsed as it streams in."""
+    if request.mimetype == 'text/csv':
+        return csv.DictReader(io.TextIOWrapper(request.stream, encoding='utf-8'))
+    rows = request.get_json()
+    if not isinstance(rows, list):
+        raise ValueError('Expected a JSON array or a CSV body')
+    return iter(rows)
+
+def with_credentials(row):
+    """Fill in a generated username and/or password; generated passwords are reported back."""
+    if row.get('username') and row.get('password'):
+        return
+    username, password = generate_viewer_credentials(row.get('listing_url'))
+    row['username'] = row.get('username') or username
+    if not row.get('password'):
+        row['password'] = password
+        row['generated_password'] = password
+
+def bulk_insert(repository, rows, build_docs):
+    """
+    Insert rows with one insert_many per BULK_CHUNK_SIZE chunk and return a
+    per-row report. build_docs turns a chunk of rows into documents,
+    or an error message per row that must be skipped. Rows that are not
+    objects are reported as errors without reaching build_docs.
+    Should the hashing pool turn a chunk away, it and every later row are
+    reported as not processed, after the rows already written.
+    """
+    report = []
+    row_number = 0
+    while True:
+        chunk = list(islice(rows, Config.BULK_CHUNK_SIZE))
+        if not chunk:
+            return report
+
+        try:
+            built = iter(build_docs([row for row in chunk if isinstance(row, dict)]))
+        except HashingBusy as e:
+            logger.error('Bulk insert stopped at row %s: %s', row_number, e)
+            return report + [
+                {"row": number, "username": row.get('username') if isinstance(row, dict) else None,
+                 "status": "error", "message": "Server busy, please try again"}
+                for number, row in enumerate(chain(chunk, rows), row_number)
+            ]
+        results = []
+        for row in chunk:
+            if isinstance(row, dict):
+                doc = next(built)
+            else:
+                row, doc = {}, 'Row must be an object'
+            result = {"row": row_number, "username": row.get('username')}
+            row_number += 1
+            if isinstance(doc, str):
+                result.update(status="error", message=doc)
+            else:
+                result.update(status="created")
+                if row.get('generated_password'):
+                    result["password"] = row['generated_password']
+            results.append((result, doc))
+
+        docs = [doc for _, doc in results if not isinstance(doc, str)]
+        pending = [result for result, doc in results if not isinstance(doc, str)]
+        for index, message in repository.insert_many(docs).items():
+            failed = pending[index]
+            failed["status"] = "error"
+            failed.pop("password", None)
+            failed["message"] = message
+        report.extend(result for result, _ in results)
 
 # User Management Routes
 
@@ -47,25 +216,48 @@ def check_admin():
 def create_viewer():
     try:
         new_viewer = request.get_json()
-        username = new_viewer.get('username')
-        viewer = viewers_collection.find_one({"username": username})
-
-        if viewer:
-            logger.error(f'Viewer {new_viewer.get("username")} already exists')
-            return jsonify({"message": "Viewer already exists"}), 400
-        
         viewer = {
             "username": new_viewer.get('username'),
             "password": new_viewer.get('password'),
             "listing_url": new_viewer.get('listing_url')
         }
-        viewers_collection.insert_one(viewer)
-        logger.info(f'Viewer {new_viewer.get("username")} created by admin')
+        try:
+            storage.viewers.insert(viewer)
+        except DuplicateError:
+            logger.error('Viewer %s already exists', new_viewer.get("username"))
+            return jsonify({"message": "Viewer already exists"}), 400
+        logger.info('Viewer %s created by admin', new_viewer.get("username"))
         return jsonify({"message": "Viewer created successfully"}), 200
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
     
+# Create many viewers from a JSON array or CSV (Admin only)
+@bp.route("/viewer/bulk", methods=["POST"])
+@login_required
+def bulk_create_viewers():
+    try:
+        def build_docs(chunk):
+            docs = []
+            for row in chunk:
+                with_credentials(row)
+                docs.append({
+                    "username": row['username'],
+                    "password": row['password'],
+                    "listing_url": row.get('listing_url')
+                })
+            return docs
+
+        report = bulk_insert(storage.bulk.viewers, iter_bulk_rows(), build_docs)
+        logger.info('%s of %s viewers created by admin', sum(r["status"] == "created" for r in report), len(report))
+        return jsonify(report), 200
+    except ValueError as e:
+        logger.error('Invalid bulk viewer request: %s', e)
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
 # Update viewer (Admin only)
 @bp.route("/viewer/update", methods=["POST"])
 @login_required
@@ -73,16 +265,16 @@ def update_viewer():
     try:
         updated_viewer = request.get_json()
         username = updated_viewer.get('username')
-        viewer = viewers_collection.find_one({"username": username})
+        viewer = storage.viewers.get(username)
 
         if not viewer:
-            logger.error(f'Viewer {updated_viewer.get("username")} does not exist')
+            logger.error('Viewer %s does not exist', updated_viewer.get("username"))
             return jsonify({"message": "Viewer does not exist"}), 400
         
-        viewers_collection.update_one({"username": username}, {"$set": updated_viewer})
+        storage.viewers.update(username, updated_viewer)
         return jsonify({"message": "Viewer updated successfully"}), 200
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
     
 # Delete viewer (Admin only)
@@ -92,26 +284,23 @@ def delete_viewer():
     try:
         data = request.get_json()
         username = data.get('username')
-        query = {"username": username}
-        viewer = viewers_collection.find_one(query)
-
-        if viewer:
-            viewers_collection.delete_one(query)
+        if storage.viewers.delete(username):
             return jsonify({"message": "Viewer deleted successfully"})
         return jsonify({"message": "Viewer does not exist"})
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
     
 @bp.route("/viewer/get", methods=["GET"])
 @login_required
 def get_viewers():
     try:
-        aggregate = viewers_collection.aggregate([{"$project": {"_id": 0}}])
-        users = [user for user in aggregate]
-        return jsonify(users)
+        projection = get_projection(viewer_fields, 'username', {"_id": 0})
+        return list_response(storage.viewers, 'username', projection)
+    except PageError as e:
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
     
 # Create user (Admin only)
@@ -121,17 +310,13 @@ def create_user():
     try:
         data = request.get_json()
 
-        if users_collection.find_one({"username": data.get('username')}):
-            logger.error(f'User {data.get("username")} already exists')
-            return jsonify({"message": "User already exists"}), 400
-
         if data.get('user_type') not in user_types:
-            logger.error(f'Invalid user type {data.get("user_type")}')
+            logger.error('Invalid user type %s', data.get("user_type"))
             return jsonify({"message": "Invalid user type"}), 400
 
         user = {
             "username": data.get('username'),
-            "password_hash": generate_password_hash(data.get('password')),
+            "password_hash": hash_password(data.get('password')),
             "user_type": data.get('user_type'),
             "first_name": data.get('first_name'),
             "last_name": data.get('last_name'),
@@ -139,12 +324,63 @@ def create_user():
             "phone": data.get('phone'),
             "listing_url": data.get('listing_url')
         }
-        users_collection.insert_one(user)
+        try:
+            storage.users.insert(user)
+        except DuplicateError:
+            logger.error('User %s already exists', data.get("username"))
+            return jsonify({"message": "User already exists"}), 400
+        user_cache.invalidate(user["username"])
         
-        logger.info(f'User {data.get("username")} created by admin')
+        logger.info('User %s created by admin', data.get("username"))
         return jsonify({"message": "User created successfully"}), 200
+    except HashingBusy as e:
+        return busy_response(e)
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
+# Create many users from a JSON array or CSV (Admin only)
+@bp.route("/user/bulk", methods=["POST"])
+@login_required
+def bulk_create_users():
+    try:
+        created = []
+
+        def build_docs(chunk):
+            for row in chunk:
+                with_credentials(row)
+            valid = [row.get('user_type', 'tenant') in user_types for row in chunk]
+            hashes = iter(hash_passwords([row['password'] for row, ok in zip(chunk, valid) if ok]))
+            docs = []
+            for row, ok in zip(chunk, valid):
+                if not ok:
+                    docs.append(f'Invalid user type {row.get("user_type")}')
+                    continue
+                docs.append({
+                    "username": row['username'],
+                    "password_hash": next(hashes),
+                    "user_type": row.get('user_type', 'tenant'),
+                    "first_name": row.get('first_name'),
+                    "last_name": row.get('last_name'),
+                    "email": row.get('email'),
+                    "phone": row.get('phone'),
+                    "listing_url": row.get('listing_url')
+                })
+                created.append(row['username'])
+            return docs
+
+        report = bulk_insert(storage.bulk.users, iter_bulk_rows(), build_docs)
+        for username in created:
+            user_cache.invalidate(username)
+        logger.info('%s of %s users created by admin', sum(r["status"] == "created" for r in report), len(report))
+        return jsonify(report), 200
+    except HashingBusy as e:
+        return busy_response(e)
+    except ValueError as e:
+        logger.error('Invalid bulk user request: %s', e)
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 # Update user (Admin only)
@@ -154,19 +390,22 @@ def update_user():
     try:
         data = request.get_json()
         username = data.get('username')
-        user = users_collection.find_one({"username": username})
+        user = storage.users.get(username)
 
         if not user:
-                logger.error(f'User {data.get("username")} doesn not exist')
+                logger.error('User %s doesn not exist', data.get("username"))
                 return jsonify({"message": "User does not exist"}), 400
 
         if "password" in data:
-            data["password_hash"] = generate_password_hash(data["password"])
+            data["password_hash"] = hash_password(data["password"])
             data.pop("password")
-        users_collection.update_one({"username": username}, {"$set": user})
+        storage.users.update(username, data)
+        user_cache.invalidate(username)
         return jsonify({"message": "User updated successfully"})
+    except HashingBusy as e:
+        return busy_response(e)
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 # Delete user (Admin only)
@@ -176,26 +415,24 @@ def delete_user():
     try:
         data = request.get_json()
         username = data.get('username')
-        query = {"username": username}
-        user = users_collection.find_one(query)
-
-        if user:
-            users_collection.delete_one(query)
+        if storage.users.delete(username):
+            user_cache.invalidate(username)
             return jsonify({"message": "User deleted successfully"})
         return jsonify({"message": "User does not exist"})
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/user/get", methods=["GET"])
 @login_required
 def get_users():
     try:
-        aggregate = users_collection.aggregate([{"$project": {"_id": 0, "password_hash": 0}}])
-        users = [user for user in aggregate]
-        return jsonify(users)
+        projection = get_projection(user_fields, 'username', {"_id": 0, "password_hash": 0})
+        return list_response(storage.users, 'username', projection)
+    except PageError as e:
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 # Listing Management Routes
@@ -210,17 +447,12 @@ def create_listing():
         # Validate required fields
         for field in required_fields:
             if not data.get(field):
-                logger.error(f'Missing required field: {field}')
+                logger.error('Missing required field: %s', field)
                 return jsonify({"message": f"Missing required field: {field}"}), 400
 
-        # Check if listing URL already exists
-        if listings_collection.find_one({"url": data.get('url')}):
-            logger.error(f'Listing with url {data.get("url")} already exists')
-            return jsonify({"message": "Listing URL already exists"}), 400
-
-        # Process and compress photos
-        photos = data.get('photos', [])
-        compressed_photos = [compress_image(photo) for photo in photos]
+        # New uploads are compressed by the job queue; ids from /listing/photos are kept
+        job = PhotoJob()
+        photos = resolve_photos(data.get('photos', []), job)
 
         # Create listing document
         listing_doc = {
@@ -228,17 +460,92 @@ def create_listing():
             "name": data.get('name'),
             "address": data.get('address'),
             "description": data.get('description', ''),
-            "photos": compressed_photos,
-            "open": data.get('open', False)
+            "photos": photos,
+            "open": data.get('open', False),
+            "status": "processing" if job.uploads else "ready",
+            "version": 1,
+            # Tells this listing from any earlier one under the same url
+            "uid": uuid.uuid4().hex,
+            "updated_at": datetime.now(timezone.utc)
         }
+        if job.uploads:
+            listing_doc["photo_jobs"] = [job.id]
 
-        listings_collection.insert_one(listing_doc)
-        logger.info(f'Listing {data.get("url")} created successfully')
-        return jsonify({"message": "Listing created successfully"}), 200
+        try:
+            storage.listings.insert(listing_doc)
+        except DuplicateError:
+            logger.error('Listing with url %s already exists', data.get("url"))
+            return jsonify({"message": "Listing URL already exists"}), 400
+        # Drop a cached "not found" for this url
+        preview_cache.invalidate(listing_doc["url"])
+        try:
+            job_id = queue_photo_job(job, listing_doc["url"])
+        except Exception:
+            storage.listings.delete(listing_doc["url"])
+            raise
+        logger.info('Listing %s created successfully', data.get("url"))
+        return jsonify({"message": "Listing created successfully", "job": job_id}), 200
+    except UploadError as e:
+        logger.error('Invalid photos for listing %s: %s', data.get("url"), e)
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
+listing_update_fields = ['name', 'address', 'description', 'open']
+
+class PhotoOpsError(ValueError):
+    pass
+
+def apply_photo_ops(photos, ops, job=None):
+    """
+    Apply {"remove": [...], "add": [...], "order": [...]} to a list of photo ids.
+    References may be ids or photo URLs; "add" takes new base64 uploads or
+    references, and "order" must list exactly the resulting photos that are
+    not still being processed (those move to the end).
+    """
+    removed = {ref_to_id(ref) for ref in ops.get("remove", [])}
+    photos = [photo for photo in photos if photo not in removed]
+    if ops.get("add"):
+        photos = photos + [photo for photo in resolve_photos(ops["add"], job) if photo not in photos]
+    if "order" in ops:
+        order = [ref_to_id(ref) for ref in ops["order"]]
+        pending = [photo for photo in photos if is_pending(photo)]
+        if sorted(order) != sorted(photo for photo in photos if not is_pending(photo)):
+            raise PhotoOpsError("Photo order must list every photo exactly once")
+        photos = order + pending
+    return photos
+
+def queue_photo_job(job, listing_url):
+    """
+    Enqueue the uploads collected in job once the listing refers to them.
+    Returns the job id, or None when the request had no uploads.
+    """
+    if not job.uploads:
+        return None
+    try:
+        return job.enqueue(listing_url)
+    except Exception:
+        # Nothing would ever replace the placeholders
+        storage.listings.release_photo_job(listing_url, job.id, job.placeholders)
+        raise
+
+def photo_update(photos, new_photos):
+    """Smallest update turning the stored photo array into new_photos."""
+    if new_photos == photos:
+        return {}
+    if new_photos[:len(photos)] == photos:
+        return {"$push": {"photos": {"$each": new_photos[len(photos):]}}}
+    removed = [photo for photo in photos if photo not in new_photos]
+    if removed and [photo for photo in photos if photo not in removed] == new_photos:
+        return {"$pull": {"photos": {"$in": removed}}}
+    return {"$set": {"photos": new_photos}}
+
+def merge_updates(update, other):
+    for operator, fields in other.items():
+        update.setdefault(operator, {}).update(fields)
+    return update
+
 @bp.route("/listing/update", methods=["POST"])
 @login_required
 def update_listing():
@@ -251,32 +558,113 @@ def update_listing():
             return jsonify({"message": "Missing listing URL"}), 400
 
         # Check if listing exists
-        existing_listing = listings_collection.find_one({"url": listing_url})
+        existing_listing = storage.listings.get(listing_url)
         if not existing_listing:
-            logger.error(f'Listing with URL {listing_url} not found')
+            logger.error('Listing with URL %s not found', listing_url)
             return jsonify({"message": "Listing not found"}), 404
 
-        # Process and compress photos
-        photos = data.get('photos', [])
-        compressed_photos = [compress_image(photo) for photo in photos]
-
-        # Update listing document
-        update_data = {
-            "name": data.get('name'),
-            "address": data.get('address'),
-            "description": data.get('description', ''),
-            "photos": compressed_photos,
-            "open": data.get('open', False)
+        # Only fields the client sent and that actually changed are written
+        update = {}
+        changes = {
+            field: data[field] for field in listing_update_fields
+            if field in data and data[field] != existing_listing.get(field)
         }
+        if changes:
+            update["$set"] = changes
+
+        photos = existing_listing.get("photos", [])
+        new_photos = photos
+        job = PhotoJob()
+        if "photos" in data:
+            # Clients never see photos still being processed, so those are kept
+            new_photos = resolve_photos(data["photos"], job)
+            new_photos += [photo for photo in photos if is_pending(photo) and photo not in new_photos]
+        if "photo_ops" in data:
+            new_photos = apply_photo_ops(new_photos, data["photo_ops"], job)
+        update = merge_updates(update, photo_update(photos, new_photos))
+        if job.uploads:
+            update = merge_updates(update, {
+                "$set": {"status": "processing"},
+                "$push": {"photo_jobs": job.id}
+            })
+
+        if update:
+            update = merge_updates(update, {
+                "$inc": {"version": 1},
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            })
+            # The photo array was computed from what we read: a photo job may
+            # have swapped a placeholder since, which a $set would put back
+            if not storage.listings.update(listing_url, update, version=existing_listing.get("version")):
+                logger.error('Listing %s changed while being updated', listing_url)
+                return jsonify({"message": "Listing changed while updating, please try again"}), 409
+            preview_cache.invalidate(listing_url)
+        job_id = queue_photo_job(job, listing_url)
+        logger.info('Listing %s updated successfully', listing_url)
+        return jsonify({
+            "message": "Listing updated successfully",
+            "photos": with_photo_urls({"url": listing_url, "photos": new_photos})["photos"],
+            "job": job_id
+        }), 200
+    except PhotoOpsError as e:
+        logger.error('Invalid photo operations for listing %s: %s', data.get("url"), e)
+        return jsonify({"message": str(e)}), 400
+    except UploadError as e:
+        logger.error('Invalid photos for listing %s: %s', data.get("url"), e)
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
+@bp.route("/listing/photos", methods=["POST"])
+@login_required
+def upload_listing_photos():
+    """
+    multipart/form-data upload of one or more "photos" files, stored without a
+    base64 round trip. With a "url" field the photos are appended to that
+    listing; otherwise their ids can be passed to listing create/update.
+    """
+    try:
+        photos = uploaded_photos(request.files)
+        listing_url = request.form.get('url')
+        if listing_url and not storage.listings.get(listing_url, {"url": 1}):
+            logger.error('Listing with URL %s not found', listing_url)
+            return jsonify({"message": "Listing not found"}), 404
 
-        listings_collection.update_one(
-            {"url": listing_url},
-            {"$set": update_data}
-        )
-        logger.info(f'Listing {listing_url} updated successfully')
-        return jsonify({"message": "Listing updated successfully"}), 200
+        photo_ids = store_uploads(photos)
+        if not listing_url:
+            return jsonify({"photos": photo_ids}), 200
+
+        storage.listings.update(listing_url, {
+            "$push": {"photos": {"$each": photo_ids}},
+            "$inc": {"version": 1},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        })
+        preview_cache.invalidate(listing_url)
+        logger.info('Uploaded %s photos to listing %s', len(photo_ids), listing_url)
+        return jsonify({
+            "photos": with_photo_urls({"url": listing_url, "photos": photo_ids})["photos"]
+        }), 200
+    except RequestEntityTooLarge as e:
+        logger.error('Photo upload too large: %s', e.description)
+        return jsonify({"message": e.description}), 413
+    except UploadError as e:
+        logger.error('Invalid photo upload: %s', e)
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+@login_required
+def get_job(job_id):
+    try:
+        status = job_status(job_id)
+        if status is None:
+            return jsonify({"message": "Job not found"}), 404
+        return jsonify(status), 200
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/listing/delete", methods=["POST"])
@@ -290,38 +678,53 @@ def delete_listing():
             logger.error('Missing listing URL')
             return jsonify({"message": "Missing listing URL"}), 400
 
-        result = listings_collection.delete_one({"url": listing_url})
+        deleted = storage.listings.delete(listing_url)
+        preview_cache.invalidate(listing_url)
         
-        if result.deleted_count > 0:
-            logger.info(f'Listing {listing_url} deleted successfully')
+        if deleted:
+            logger.info('Listing %s deleted successfully', listing_url)
             return jsonify({"message": "Listing deleted successfully"}), 200
         else:
-            logger.error(f'Listing with URL {listing_url} not found')
+            logger.error('Listing with URL %s not found', listing_url)
             return jsonify({"message": "Listing not found"}), 404
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/listing/get", methods=["GET"])
 @login_required
 def get_listings():
     try:
-        listings = list(listings_collection.find({}, {"_id": 0}))
-        return jsonify(listings)
+        projection = get_projection(listing_fields, 'url', {"_id": 0})
+        return list_response(storage.listings, 'url', projection, with_photo_urls)
+    except PageError as e:
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
     
+@bp.route("/listing/search", methods=["GET"])
+@login_required
+def search_listings_admin():
+    try:
+        listings, next_cursor = search_listings(storage.listings, request.args)
+        return page_response(listings, next_cursor, cursor_param='cursor')
+    except PageError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
 @bp.route("/listing/get-credentials/<listing_url>", methods=["POST"])
 def get_credentials(listing_url):
-    existing_listing = listings_collection.find_one({"url": listing_url})
+    existing_listing = storage.listings.get(listing_url, {"url": 1})
     if not existing_listing:
-        logger.error(f'Listing with URL {listing_url} not found')
+        logger.error('Listing with URL %s not found', listing_url)
         return jsonify({"message": "Listing not found"}), 404
     
-    results = users_collection.find({"listing_url": listing_url}, {"username": 1, "password": 1, "_id": 0})
+    results = storage.users.by_listing(listing_url, {"username": 1, "password": 1})
     if not results:
-        logger.error(f'Viewer for listing with URL {listing_url} not found')
+        logger.error('Viewer for listing with URL %s not found', listing_url)
         return jsonify({"message": "No viewer account found for that listing"}), 404
     
     existing_viewers = [viewer for viewer in results]
@@ -1,21 +1,17 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, login_user, logout_user, current_user
-from werkzeug.security import (
-    check_password_hash, 
-    generate_password_hash
-)
 import os, sys
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
-from db import MongoConnector
-from user import User
+from repositories import DuplicateError, storage
+from user import user_from_document
+from cache import user_cache
+from passwords import HashingBusy, busy_response, check_password, hash_password, needs_rehash
 import logging
 logger = logging.getLogger('lucky_house')
 
-mongoClient = MongoConnector()
 bp = Blueprint('auth', __name__)
-collection = mongoClient.get_collection('users')
 
 
 @bp.route('/', methods=["GET"])
@@ -35,43 +31,63 @@ def register():
     try:
         data = request.get_json()
 
-        if collection.find_one({"username": str(data["username"])}):
-            logger.error(f'Username {data["username"]} already exists')
-            return jsonify({"message": "Username already exists"}), 400
-        
-        data["password_hash"] = generate_password_hash(data["password"])
+        data["username"] = str(data["username"])
+        data["password_hash"] = hash_password(data["password"])
         data.pop("password")
 
         if "user_type" not in data:
             data["user_type"] = "viewer"
 
-        collection.insert_one(data)
-        logger.info(f'User {data["username"]} registered')
+        try:
+            storage.users.insert(data)
+        except DuplicateError:
+            logger.error('Username %s already exists', data["username"])
+            return jsonify({"message": "Username already exists"}), 400
+        user_cache.invalidate(data["username"])
+        logger.info('User %s registered', data["username"])
 
         return jsonify({"message": "User registered successfully"}), 200
+    except HashingBusy as e:
+        return busy_response(e)
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
+def rehash_password(user, password):
+    """Upgrade a stored hash to the current parameters. Best effort."""
+    try:
+        user["password_hash"] = hash_password(password)
+        storage.users.update(user["username"], {"password_hash": user["password_hash"]})
+        user_cache.invalidate(user["username"])
+        logger.info('Rehashed password for %s', user["username"])
+    except HashingBusy:
+        # Try again on a later login rather than failing this one
+        pass
+
 @bp.route("/login", methods=["POST"])
 def login():
     try:
         data = request.get_json()
-        user = collection.find_one({"username": str(data["username"])})
+        user = storage.users.get(str(data["username"]))
 
         if user:
-            if not check_password_hash(user["password_hash"], data["password"]):
-                logger.error(f'Incorrect password for {data["username"]}')
+            if not check_password(user["password_hash"], data["password"]):
+                logger.error('Incorrect password for %s', data["username"])
                 return jsonify({"message": "Incorrect password"}), 401
 
-            currUser = User(username=user["username"], pw=user["password_hash"], user_type=user["user_type"], first_name=user.get("first_name"), last_name=user.get("last_name"), email=user.get("email"), phone=user.get("phone"), listing_url=user.get("listing_url"))
+            if needs_rehash(user["password_hash"]):
+                rehash_password(user, data["password"])
+
+            currUser = user_from_document(user)
             login_user(currUser, remember=True)
             return jsonify({"message": "Login successful"}), 200
         else:
-            logger.error(f'Username {data["username"]} not found')
+            logger.error('Username %s not found', data["username"])
             return jsonify({"message": "Username not found"}), 401
+    except HashingBusy as e:
+        return busy_response(e)
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/logout", methods=["POST"])
@@ -1,38 +1,130 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import wrap_file
 from flask_login import login_required, current_user
 import os, sys
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
-from db import MongoConnector
+from config import Config
+from repositories import PhotoNotFound, storage
+from cache import preview_cache, MISSING
+from photo_store import open_photo, photo_url, with_photo_urls
+from jobs import is_pending
+from pagination import PageError, page_response
+from search import search_listings
+import hashlib
+import json
 import logging
 
 logger = logging.getLogger('lucky_house')
-mongoClient = MongoConnector()
 bp = Blueprint('listing', __name__)
 
-listings_collection = mongoClient.get_collection('listings')
+# Listing reads here may be served by secondaries (storage.public), up to
+# MONGO_MAX_STALENESS_SECONDS behind the writes the admin routes make. The
+# preview cache is filled from the primary instead: an entry outlives that lag
+# and would pin a stale preview right after its invalidation.
+
+# Photo ids are content hashes, so a given URL never changes
+PHOTO_MAX_AGE = 31536000
+PREVIEW_SIZE = 'medium'
+
+# Projections and response bodies are shared with the async handlers in asgi.py
+PREVIEW_PROJECTION = {"_id": 0, "name": 1, "photos": {"$slice": 1}}  # Only return first photo
+DETAILS_PROJECTION = {"_id": 0}
+# Enough to know a listing exists and which version of it the client has
+VERSION_PROJECTION = {"_id": 0, "url": 1, "uid": 1, "version": 1}
+
+def preview_body(url_token, preview, base_url=None):
+    """Return limited listing information"""
+    photo = preview["preview_photo"]
+    return {
+        "name": preview["name"],
+        "preview_photo": photo_url(url_token, photo, size=PREVIEW_SIZE, base_url=base_url) if photo else None
+    }
+
+def cache_preview(url_token, listing):
+    """
+    Cache the preview of a listing found by url_token as (preview, etag), or
+    None if there is no such listing. Not-found results are only cached for
+    PREVIEW_NEGATIVE_TTL seconds.
+    The cached preview holds the photo id, not its URL: URLs follow the Host
+    header of each request and must not leak into other requests' answers.
+    """
+    preview = None
+    if listing:
+        photos = [ref for ref in listing.get("photos") or [] if not is_pending(ref)]
+        data = {"name": listing.get("name"), "preview_photo": photos[0] if photos else None}
+        etag = hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        preview = (data, etag)
+    preview_cache.set(url_token, preview, ttl=None if preview else Config.PREVIEW_NEGATIVE_TTL)
+    return preview
+
+def details_etag(listing):
+    """
+    Listings carry a version bumped by every write, so with the uid drawn at
+    creation it names their content, even once a url is deleted and reused.
+    """
+    uid = listing.get("uid")
+    version = listing.get("version", 0)
+    return f'{listing["url"]}-{uid}-v{version}' if uid else f'{listing["url"]}-v{version}'
+
+def can_view_listings(user):
+    return user.user_type in ['admin', 'viewer']
+
+def can_view_listing(user, url_token):
+    """Viewers may only see the listing their account was created for."""
+    if user.user_type == 'viewer':
+        return getattr(user, 'listing_url', None) == url_token
+    return can_view_listings(user)
+
+# Viewers only ever see open listings, without admin-only fields
+VIEWER_SEARCH_PROJECTION = {"_id": 0, "url": 1, "name": 1, "address": 1}
+
+@bp.route("/search", methods=["GET"])
+@login_required
+def search_open_listings():
+    """Search open listings; viewer accounts only find their own listing."""
+    try:
+        if not can_view_listings(current_user):
+            logger.error('User %s does not have permission to view listings', current_user.username)
+            return jsonify({"message": "Unauthorized"}), 403
+
+        base_filter = {"open": True}
+        if current_user.user_type == 'viewer':
+            base_filter["url"] = current_user.listing_url
+        listings, next_cursor = search_listings(
+            storage.public.listings, request.args, base_filter, VIEWER_SEARCH_PROJECTION
+        )
+        return page_response(listings, next_cursor, cursor_param='cursor')
+    except PageError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/<url_token>", methods=["GET"])
 def get_public_listing(url_token):
     """Get basic listing information for public view."""
     try:
-        listing = listings_collection.find_one(
-            {"url": url_token},
-            {"_id": 0, "name": 1, "photos": {"$slice": 1}}  # Only return first photo
-        )
+        preview = preview_cache.get(url_token)
+        if preview is MISSING:
+            listing = storage.listings.get(url_token, PREVIEW_PROJECTION)
+            preview = cache_preview(url_token, listing)
         
-        if not listing:
-            logger.error(f'Listing with token {url_token} not found')
+        if not preview:
+            logger.error('Listing with token %s not found', url_token)
             return jsonify({"message": "Listing not found"}), 404
             
-        # Return limited listing information
-        return jsonify({
-            "name": listing.get("name"),
-            "preview_photo": listing.get("photos", [])[0] if listing.get("photos") else None
-        })
+        data, etag = preview
+        response = jsonify(preview_body(url_token, data))
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = Config.PREVIEW_MAX_AGE
+        # Answers If-None-Match with a 304
+        return response.make_conditional(request)
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
+        logger.error('An error occurred: %s', e)
         return jsonify({"message": "An error occurred"}), 500
 
 @bp.route("/<url_token>/details", methods=["GET"])
@@ -40,23 +132,87 @@ def get_public_listing(url_token):
 def get_listing_details(url_token):
     """Get full listing details for authenticated viewers."""
     try:
-        # Check if the user has access to this listing
-        if current_user.user_type not in ['admin', 'viewer']:
-            logger.error(f'User {current_user.username} does not have permission to view listings')
+        # Authorize before touching the database: the user already says what it may see
+        if not can_view_listings(current_user):
+            logger.error('User %s does not have permission to view listings', current_user.username)
             return jsonify({"message": "Unauthorized"}), 403
-            
-        listing = listings_collection.find_one({"url": url_token}, {"_id": 0})
+
+        # For viewers, check if they have access to this specific listing
+        if not can_view_listing(current_user, url_token):
+            logger.error('Viewer %s does not have access to listing %s', current_user.username, url_token)
+            return jsonify({"message": "Unauthorized"}), 403
+
+        version = storage.public.listings.get(url_token, VERSION_PROJECTION)
+        if not version:
+            logger.error('Listing with token %s not found', url_token)
+            return jsonify({"message": "Listing not found"}), 404
+
+        etag = details_etag(version)
+        if request.if_none_match.contains(etag):
+            return details_not_modified(etag)
+
+        listing = storage.public.listings.get(url_token, DETAILS_PROJECTION)
         if not listing:
-            logger.error(f'Listing with token {url_token} not found')
+            logger.error('Listing with token %s not found', url_token)
             return jsonify({"message": "Listing not found"}), 404
-            
-        # For viewers, check if they have access to this specific listing
-        if current_user.user_type == 'viewer':
-            if not hasattr(current_user, 'listing_url') or current_user.listing_url != listing['id']:
-                logger.error(f'Viewer {current_user.username} does not have access to listing {listing["id"]}')
-                return jsonify({"message": "Unauthorized"}), 403
-                
-        return jsonify(listing)
+
+        etag = details_etag(listing)
+        # The uid only serves the ETag; photo jobs are internal bookkeeping
+        listing.pop("uid", None)
+        listing.pop("photo_jobs", None)
+        response = jsonify(with_photo_urls(listing))
+        set_details_caching(response, etag)
+        return response
     except Exception as e:
-        logger.error(f'An error occurred: {e}')
-        return jsonify({"message": "An error occurred"}), 500 
\ No newline at end of file
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
+
+def set_details_caching(response, etag):
+    # Per-user content: browsers may keep it but must revalidate every time
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def details_not_modified(etag):
+    return set_details_caching(Response(status=304), etag)
+
+@bp.route("/<url_token>/photos/<photo_id>", methods=["GET"])
+def get_listing_photo(url_token, photo_id):
+    """
+    Stream a listing photo with ETag, Cache-Control and Range support.
+    ?size=thumb|medium serves a smaller rendition.
+    """
+    try:
+        # Photo URLs are handed out right after upload: a miss may just not be replicated yet
+        if not (storage.public.listings.has_photo(url_token, photo_id)
+                or storage.listings.has_photo(url_token, photo_id)):
+            logger.error('Photo %s not found on listing %s', photo_id, url_token)
+            return jsonify({"message": "Photo not found"}), 404
+
+        try:
+            photo = open_photo(photo_id, request.args.get('size'))
+        except PhotoNotFound:
+            logger.error('Photo %s missing from photo store', photo_id)
+            return jsonify({"message": "Photo not found"}), 404
+
+        metadata = photo.metadata or {}
+        response = Response(
+            wrap_file(request.environ, photo),
+            mimetype=metadata.get("contentType", "image/jpeg"),
+            direct_passthrough=True
+        )
+        response.content_length = photo.length
+        response.last_modified = photo.upload_date
+        response.set_etag(photo._id)
+        response.cache_control.public = True
+        response.cache_control.max_age = PHOTO_MAX_AGE
+        response.cache_control.immutable = True
+        # Handles If-None-Match (304) and Range (206) against the seekable file
+        return response.make_conditional(request, accept_ranges=True, complete_length=photo.length)
+    except HTTPException:
+        # e.g. 416 for an unsatisfiable Range header
+        raise
+    except Exception as e:
+        logger.error('An error occurred: %s', e)
+        return jsonify({"message": "An error occurred"}), 500
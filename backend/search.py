@@ -0,0 +1,78 @@
+from config import Config
+from pagination import PageError, decode_cursor, encode_cursor
+
+# Listing search results never carry photos or descriptions
+SUMMARY_PROJECTION = {"_id": 0, "url": 1, "name": 1, "address": 1, "open": 1}
+
+# Every sort ends on the unique url so keyset cursors are stable
+SORTS = {
+    'url': [('url', 1)],
+    '-url': [('url', -1)],
+    'name': [('name', 1), ('url', 1)],
+    '-name': [('name', -1), ('url', -1)],
+}
+
+# Relative weight of each field in the text search score
+TEXT_WEIGHTS = {'name': 10, 'address': 5, 'description': 1}
+
+def parse_bool(value, name):
+    if value not in ('true', 'false'):
+        raise PageError(f'{name} must be true or false')
+    return value == 'true'
+
+def parse_search(args, base_filter=None):
+    """
+    Validate search query args into the parameters the listing repositories run:
+      q       full-text search over name, address and description
+      open    true/false
+      sort    url, -url, name, -name or relevance (the default when q is given)
+      limit   page size, capped at ADMIN_MAX_PAGE_SIZE
+      cursor  opaque cursor from the previous page
+    base_filter holds equality filters on open and url the caller enforces.
+    """
+    filters = dict(base_filter or {})
+    if args.get('open') is not None and 'open' not in filters:
+        filters['open'] = parse_bool(args.get('open'), 'open')
+    text = (args.get('q') or '').strip()
+
+    limit = args.get('limit', Config.ADMIN_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, Config.ADMIN_MAX_PAGE_SIZE))
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else {}
+    sort = args.get('sort') or ('relevance' if text else 'url')
+
+    if sort == 'relevance':
+        if not text:
+            raise PageError('Sorting by relevance needs a search query')
+        # Text scores can't be used as keyset bounds, so relevance pages by offset
+        offset = cursor.get('offset', 0)
+        if type(offset) is not int or offset < 0:
+            raise PageError('Invalid cursor')
+        return {"filter": filters, "text": text, "sort": sort, "limit": limit, "offset": offset}
+
+    if sort not in SORTS:
+        raise PageError(f'Unknown sort: {sort}')
+    after = cursor.get('after')
+    if after is not None:
+        # Keyset bounds are url and name strings; a listing may have no name
+        if not isinstance(after, list) or not all(value is None or isinstance(value, str) for value in after):
+            raise PageError('Invalid cursor')
+        if len(after) != len(SORTS[sort]):
+            raise PageError('Cursor does not match sort')
+    return {"filter": filters, "text": text, "sort": sort, "limit": limit, "after": after}
+
+def search_page(docs, params):
+    """Trim the limit + 1 documents a search fetched to the page and the next cursor."""
+    limit = params["limit"]
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    if params["sort"] == 'relevance':
+        return docs, encode_cursor({'offset': params["offset"] + limit})
+    return docs, encode_cursor({'after': [docs[-1].get(key) for key, _ in SORTS[params["sort"]]]})
+
+def search_listings(listings, args, base_filter=None, projection=SUMMARY_PROJECTION):
+    """
+    Search a listing repository from query args (see parse_search).
+    Returns the page and the next cursor (None on the last page).
+    """
+    return listings.search(parse_search(args, base_filter), projection)
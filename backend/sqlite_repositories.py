@@ -0,0 +1,479 @@
+"""
+Repositories in an embedded SQLite file (Config.SQLITE_DATABASE), for
+single-node and test deployments that run without a Mongo server.
+
+Documents are stored as JSON next to the columns they are looked up and
+sorted by, which carry the same indexes as the Mongo collections
+(indexes.py). Listing text search runs on an FTS5 table kept in step with
+the listings and weighted like the Mongo text index.
+
+The file is in WAL mode, so readers never wait on the writer. Writes are
+read-modify-write in BEGIN IMMEDIATE transactions: concurrent writers
+(threads or worker processes) queue on the write lock instead of losing
+each other's updates.
+"""
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from repositories import (
+    ANY_VERSION, AccountRepository, DuplicateError, ListingRepository, PhotoNotFound, PhotoRepository
+)
+from search import SORTS, TEXT_WEIGHTS, search_page
+
+TEXT_FIELDS = list(TEXT_WEIGHTS)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    listing_url TEXT,
+    doc TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_listing_url ON users (listing_url);
+CREATE TABLE IF NOT EXISTS viewers (
+    username TEXT PRIMARY KEY,
+    listing_url TEXT,
+    doc TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS viewers_listing_url ON viewers (listing_url);
+CREATE TABLE IF NOT EXISTS listings (
+    url TEXT NOT NULL UNIQUE,
+    name TEXT,
+    open INTEGER,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_open_url ON listings (open, url);
+CREATE INDEX IF NOT EXISTS listings_name_url ON listings (name, url);
+CREATE INDEX IF NOT EXISTS listings_open_name_url ON listings (open, name, url);
+CREATE VIRTUAL TABLE IF NOT EXISTS listings_text USING fts5(
+    {', '.join(TEXT_FIELDS)}, tokenize='porter unicode61'
+);
+CREATE TABLE IF NOT EXISTS photos (
+    id TEXT PRIMARY KEY,
+    content_type TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    upload_date REAL NOT NULL,
+    renditions TEXT,
+    upload_sha256 TEXT,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_upload_sha256 ON photos (upload_sha256) WHERE upload_sha256 IS NOT NULL;
+"""
+
+# Bound parameters per IN (...) query, under SQLite's limit
+IN_CHUNK_SIZE = 500
+
+def _encode(value):
+    if isinstance(value, datetime):
+        # Stored as naive UTC, which is also what pymongo hands back
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return {"$date": value.isoformat()}
+    raise TypeError(f'Cannot store {type(value).__name__}')
+
+def _decode(value):
+    if len(value) == 1 and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+def dumps(doc):
+    return json.dumps(doc, default=_encode, separators=(',', ':'))
+
+def loads(text):
+    return json.loads(text, object_hook=_decode)
+
+def project(doc, projection):
+    """Apply a Mongo-style projection: inclusion, exclusion and $slice on top-level fields."""
+    if doc is None or not projection:
+        return doc
+    fields = {key: spec for key, spec in projection.items() if key != '_id'}
+    included = [key for key, spec in fields.items() if spec and not isinstance(spec, dict)]
+    if included:
+        doc = {key: value for key, value in doc.items() if key in fields}
+    else:
+        doc = {key: value for key, value in doc.items() if fields.get(key, 1)}
+    for key, spec in fields.items():
+        if isinstance(spec, dict) and '$slice' in spec and isinstance(doc.get(key), list):
+            count = spec['$slice']
+            doc[key] = doc[key][:count] if count >= 0 else doc[key][count:]
+    return doc
+
+def apply_update(doc, update):
+    """Apply $set, $unset, $inc, $push ($each) and $pull ($in) the way Mongo would."""
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            if '.' in field:
+                raise ValueError(f'Nested update of {field} is not supported')
+            if operator == '$set':
+                doc[field] = value
+            elif operator == '$unset':
+                doc.pop(field, None)
+            elif operator == '$inc':
+                doc[field] = doc.get(field, 0) + value
+            elif operator == '$push':
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                doc[field] = list(doc.get(field) or []) + list(items)
+            elif operator == '$pull':
+                if field in doc:
+                    removed = value['$in'] if isinstance(value, dict) and '$in' in value else [value]
+                    doc[field] = [item for item in doc[field] if item not in removed]
+            else:
+                raise ValueError(f'Unsupported update operator: {operator}')
+    return doc
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        yield values[start:start + IN_CHUNK_SIZE]
+
+def _is_duplicate(error):
+    # As opposed to e.g. a NOT NULL key
+    return 'UNIQUE' in str(error)
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+class SQLiteDatabase:
+    def __init__(self, path, schema=SCHEMA):
+        self.path = path
+        self.schema = schema
+        self._reset()
+        # Connections are per thread and per process: a child opens its own on first use
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def connect(self):
+        """This thread's connection, creating the schema on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Durable at each checkpoint rather than each commit; safe with WAL
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.schema)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT: take the write lock before reading what will be written."""
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+class SQLiteAccounts(AccountRepository):
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+    def _row(self, doc):
+        return (doc.get("username"), doc.get("listing_url"), dumps(doc))
+
+    def get(self, username, projection=None):
+        row = self.db.connect().execute(f'SELECT doc FROM {self.table} WHERE username = ?', (username,)).fetchone()
+        return project(loads(row['doc']), projection) if row else None
+
+    def insert(self, doc):
+        try:
+            with self.db.transaction() as conn:
+                conn.execute(f'INSERT INTO {self.table} (username, listing_url, doc) VALUES (?, ?, ?)', self._row(doc))
+        except sqlite3.IntegrityError as e:
+            if not _is_duplicate(e):
+                raise
+            raise DuplicateError(doc.get("username"))
+
+    def insert_many(self, docs):
+        errors = {}
+        with self.db.transaction() as conn:
+            for index, doc in enumerate(docs):
+                try:
+                    conn.execute(f'INSERT INTO {self.table} (username, listing_url, doc) VALUES (?, ?, ?)', self._row(doc))
+                except sqlite3.IntegrityError as e:
+                    errors[index] = "Already exists" if _is_duplicate(e) else str(e)
+        return errors
+
+    def update(self, username, fields):
+        with self.db.transaction() as conn:
+            row = conn.execute(f'SELECT doc FROM {self.table} WHERE username = ?', (username,)).fetchone()
+            if row is None:
+                return False
+            doc = apply_update(loads(row['doc']), {"$set": fields})
+            try:
+                conn.execute(
+                    f'UPDATE {self.table} SET username = ?, listing_url = ?, doc = ? WHERE username = ?',
+                    self._row(doc) + (username,)
+                )
+            except sqlite3.IntegrityError as e:
+                if not _is_duplicate(e):
+                    raise
+                raise DuplicateError(doc.get("username"))
+        return True
+
+    def delete(self, username):
+        with self.db.transaction() as conn:
+            return conn.execute(f'DELETE FROM {self.table} WHERE username = ?', (username,)).rowcount > 0
+
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        # Rows are read off the cursor one at a time, so batch_size has nothing to tune
+        where = 'WHERE username > ?' if after else ''
+        rows = self.db.connect().execute(
+            f'SELECT doc FROM {self.table} {where} ORDER BY username LIMIT ?',
+            ((after,) if after else ()) + (limit or -1,)
+        )
+        return (project(loads(row['doc']), projection) for row in rows)
+
+    def by_listing(self, listing_url, projection=None):
+        rows = self.db.connect().execute(
+            f'SELECT doc FROM {self.table} WHERE listing_url = ? ORDER BY username', (listing_url,)
+        )
+        return [project(loads(row['doc']), projection) for row in rows]
+
+def _open_column(value):
+    # Like a Mongo filter on true/false, only booleans match
+    return int(value) if isinstance(value, bool) else None
+
+def _text_columns(doc):
+    return tuple(doc.get(field) if isinstance(doc.get(field), str) else '' for field in TEXT_FIELDS)
+
+def match_query(text):
+    """FTS5 query matching any of the words, as Mongo's $text does."""
+    words = re.findall(r'\w+', text)
+    return ' OR '.join(f'"{word}"' for word in words) or None
+
+def _keyset_sql(keys, values):
+    """SQL twin of pagination.keyset_filter."""
+    clauses, args = [], []
+    for i, (key, direction) in enumerate(keys):
+        clauses.append('(' + ' AND '.join(
+            [f'l.{k} = ?' for k, _ in keys[:i]] + [f'l.{key} {">" if direction == 1 else "<"} ?']
+        ) + ')')
+        args += list(values[:i + 1])
+    return '(' + ' OR '.join(clauses) + ')', args
+
+class SQLiteListings(ListingRepository):
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, url, projection=None):
+        row = self.db.connect().execute('SELECT doc FROM listings WHERE url = ?', (url,)).fetchone()
+        return project(loads(row['doc']), projection) if row else None
+
+    def has_photo(self, url, photo_id):
+        listing = self.get(url, {"photos": 1})
+        return listing is not None and photo_id in (listing.get("photos") or [])
+
+    def insert(self, doc):
+        try:
+            with self.db.transaction() as conn:
+                cursor = conn.execute(
+                    'INSERT INTO listings (url, name, open, doc) VALUES (?, ?, ?, ?)',
+                    (doc.get("url"), doc.get("name"), _open_column(doc.get("open")), dumps(doc))
+                )
+                conn.execute(
+                    f'INSERT INTO listings_text (rowid, {", ".join(TEXT_FIELDS)}) VALUES (?, {_placeholders(TEXT_FIELDS)})',
+                    (cursor.lastrowid,) + _text_columns(doc)
+                )
+        except sqlite3.IntegrityError as e:
+            if not _is_duplicate(e):
+                raise
+            raise DuplicateError(doc.get("url"))
+
+    @contextlib.contextmanager
+    def _modify(self, url, version=ANY_VERSION):
+        """
+        Yield the listing for changes in place, written back on exit; None if
+        missing or, given a version, at another version.
+        """
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT rowid, doc FROM listings WHERE url = ?', (url,)).fetchone()
+            doc = loads(row['doc']) if row else None
+            if doc is not None and version is not ANY_VERSION and doc.get("version") != version:
+                doc = None
+            yield doc
+            if doc is None:
+                return
+            try:
+                conn.execute(
+                    'UPDATE listings SET url = ?, name = ?, open = ?, doc = ? WHERE rowid = ?',
+                    (doc.get("url"), doc.get("name"), _open_column(doc.get("open")), dumps(doc), row['rowid'])
+                )
+            except sqlite3.IntegrityError as e:
+                if not _is_duplicate(e):
+                    raise
+                raise DuplicateError(doc.get("url"))
+            conn.execute(
+                f'UPDATE listings_text SET {", ".join(f"{field} = ?" for field in TEXT_FIELDS)} WHERE rowid = ?',
+                _text_columns(doc) + (row['rowid'],)
+            )
+
+    def update(self, url, update, version=ANY_VERSION):
+        with self._modify(url, version) as doc:
+            if doc is not None:
+                apply_update(doc, update)
+        return doc is not None
+
+    def delete(self, url):
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT rowid FROM listings WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('DELETE FROM listings WHERE rowid = ?', (row['rowid'],))
+            conn.execute('DELETE FROM listings_text WHERE rowid = ?', (row['rowid'],))
+        return True
+
+    def list(self, after=None, limit=None, projection=None, batch_size=None):
+        where = 'WHERE url > ?' if after else ''
+        rows = self.db.connect().execute(
+            f'SELECT doc FROM listings {where} ORDER BY url LIMIT ?',
+            ((after,) if after else ()) + (limit or -1,)
+        )
+        return (project(loads(row['doc']), projection) for row in rows)
+
+    def search(self, params, projection):
+        where, args = [], []
+        for field, value in params["filter"].items():
+            if field not in ('open', 'url'):
+                raise ValueError(f'Cannot filter listings on {field}')
+            where.append(f'l.{field} = ?')
+            args.append(_open_column(value) if field == 'open' else value)
+
+        match = None
+        if params["text"]:
+            match = match_query(params["text"])
+            if match is None:
+                return [], None
+
+        if params["sort"] == 'relevance':
+            weights = ', '.join(str(float(TEXT_WEIGHTS[field])) for field in TEXT_FIELDS)
+            sql = (
+                f'SELECT l.doc, -bm25(listings_text, {weights}) AS score '
+                'FROM listings_text JOIN listings l ON l.rowid = listings_text.rowid '
+                f'WHERE {" AND ".join(["listings_text MATCH ?"] + where)} '
+                'ORDER BY score DESC, l.url LIMIT ? OFFSET ?'
+            )
+            rows = self.db.connect().execute(sql, [match] + args + [params["limit"] + 1, params["offset"]])
+            docs = [{**project(loads(row['doc']), projection), "score": row['score']} for row in rows]
+            return search_page(docs, params)
+
+        keys = SORTS[params["sort"]]
+        if match is not None:
+            where.append('l.rowid IN (SELECT rowid FROM listings_text WHERE listings_text MATCH ?)')
+            args.append(match)
+        if params["after"] is not None:
+            clause, keyset_args = _keyset_sql(keys, params["after"])
+            where.append(clause)
+            args += keyset_args
+        order = ', '.join(f'l.{key} {"ASC" if direction == 1 else "DESC"}' for key, direction in keys)
+        sql = (
+            f'SELECT l.doc FROM listings l {"WHERE " + " AND ".join(where) if where else ""} '
+            f'ORDER BY {order} LIMIT ?'
+        )
+        rows = self.db.connect().execute(sql, args + [params["limit"] + 1])
+        return search_page([project(loads(row['doc']), projection) for row in rows], params)
+
+    def replace_photo(self, url, old, new):
+        with self._modify(url) as doc:
+            if doc is not None and old in (doc.get("photos") or []):
+                doc["photos"][doc["photos"].index(old)] = new
+                apply_update(doc, {"$set": {"updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}})
+
+    def release_photo_job(self, url, job_id, placeholders=()):
+        with self._modify(url) as doc:
+            if doc is None:
+                return
+            update = {"$pull": {"photo_jobs": job_id}}
+            if placeholders:
+                update["$pull"]["photos"] = {"$in": list(placeholders)}
+                update["$inc"] = {"version": 1}
+            apply_update(doc, update)
+            if doc.get("status") == "processing" and doc.get("photo_jobs") == []:
+                apply_update(doc, {
+                    "$set": {"status": "ready", "updated_at": datetime.now(timezone.utc)},
+                    "$inc": {"version": 1}
+                })
+
+class StoredPhoto(BytesIO):
+    """A photo read into memory, with the GridOut attributes the routes use."""
+
+    def __init__(self, row):
+        super().__init__(row['data'])
+        self._id = row['id']
+        self.length = row['length']
+        self.upload_date = datetime.fromtimestamp(row['upload_date'], timezone.utc)
+        self.metadata = {"contentType": row['content_type']}
+
+class SQLitePhotos(PhotoRepository):
+    def __init__(self, db):
+        self.db = db
+
+    def save(self, file_id, data, content_type):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO photos (id, content_type, length, upload_date, data) VALUES (?, ?, ?, ?, ?)',
+                (file_id, content_type, len(data), time.time(), data)
+            )
+
+    def set_metadata(self, file_id, renditions=None, upload_sha256=None):
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT renditions FROM photos WHERE id = ?', (file_id,)).fetchone()
+            if row is None:
+                return
+            merged = {**json.loads(row['renditions'] or '{}'), **(renditions or {})}
+            conn.execute(
+                'UPDATE photos SET renditions = ?, upload_sha256 = COALESCE(?, upload_sha256) WHERE id = ?',
+                (json.dumps(merged) if merged else None, upload_sha256, file_id)
+            )
+
+    def existing(self, file_ids):
+        conn = self.db.connect()
+        found = set()
+        for chunk in _chunks(file_ids):
+            found.update(row['id'] for row in conn.execute(
+                f'SELECT id FROM photos WHERE id IN ({_placeholders(chunk)})', chunk
+            ))
+        return found
+
+    def by_upload_hash(self, hashes):
+        conn = self.db.connect()
+        known = {}
+        for chunk in _chunks(hashes):
+            known.update((row['upload_sha256'], row['id']) for row in conn.execute(
+                f'SELECT id, upload_sha256 FROM photos WHERE upload_sha256 IN ({_placeholders(chunk)})', chunk
+            ))
+        return known
+
+    def open(self, file_id, size=None):
+        conn = self.db.connect()
+        if size and size != 'full':
+            row = conn.execute('SELECT renditions FROM photos WHERE id = ?', (file_id,)).fetchone()
+            renditions = json.loads(row['renditions'] or '{}') if row else {}
+            file_id = renditions.get(size, file_id)
+        row = conn.execute(
+            'SELECT id, content_type, length, upload_date, data FROM photos WHERE id = ?', (file_id,)
+        ).fetchone()
+        if row is None:
+            raise PhotoNotFound(file_id)
+        return StoredPhoto(row)
+
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.db = SQLiteDatabase(path)
+        self.users = SQLiteAccounts(self.db, 'users')
+        self.viewers = SQLiteAccounts(self.db, 'viewers')
+        self.listings = SQLiteListings(self.db)
+        self.photos = SQLitePhotos(self.db)
@@ -0,0 +1,63 @@
+import warnings
+from tempfile import SpooledTemporaryFile
+from flask import Request
+from PIL import Image, UnidentifiedImageError
+from werkzeug.exceptions import RequestEntityTooLarge
+from config import Config
+
+class UploadError(ValueError):
+    pass
+
+class LimitedSpool(SpooledTemporaryFile):
+    """
+    Spooled temp file for one uploaded file: kept in memory up to spool_size,
+    then on disk. Writing more than max_bytes aborts the upload mid-stream.
+    """
+    def __init__(self, max_bytes, spool_size):
+        super().__init__(max_size=spool_size)
+        self.max_bytes = max_bytes
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.max_bytes:
+            raise RequestEntityTooLarge(f'Each photo may be at most {self.max_bytes} bytes')
+        return super().write(data)
+
+class UploadRequest(Request):
+    """Request whose multipart files stream into LimitedSpool instead of memory."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return LimitedSpool(Config.PHOTO_UPLOAD_MAX_BYTES, Config.PHOTO_UPLOAD_SPOOL_SIZE)
+
+def check_image(stream):
+    """
+    Read only the image header and reject formats we do not accept and images
+    with more than PHOTO_MAX_PIXELS pixels, before anything is decoded.
+    """
+    stream.seek(0)
+    try:
+        with warnings.catch_warnings():
+            # Pillow only warns between its limit and twice that; we reject below
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(stream) as img:
+                image_format, (width, height) = img.format, img.size
+    except Image.DecompressionBombError:
+        raise UploadError('Photo has too many pixels')
+    except (UnidentifiedImageError, OSError):
+        raise UploadError('File is not a supported image')
+    finally:
+        stream.seek(0)
+    if image_format not in Config.PHOTO_UPLOAD_FORMATS:
+        raise UploadError(f'Unsupported image format: {image_format}')
+    if width * height > Config.PHOTO_MAX_PIXELS:
+        raise UploadError('Photo has too many pixels')
+    return stream
+
+def uploaded_photos(files, field='photos'):
+    """Checked streams of the photos in a multipart request, in order."""
+    photos = [upload for upload in files.getlist(field) if upload.filename]
+    if not photos:
+        raise UploadError('No photos uploaded')
+    if len(photos) > Config.PHOTO_UPLOAD_MAX_FILES:
+        raise UploadError(f'At most {Config.PHOTO_UPLOAD_MAX_FILES} photos per request')
+    return [check_image(upload.stream) for upload in photos]
@@ -14,6 +14,19 @@ class User(UserMixin):
     def get_id(self):
         return self.username
     
+def user_from_document(user):
+    """Build a User from a document of the users collection."""
+    return User(
+        username=user['username'],
+        pw=user['password_hash'],
+        user_type=user['user_type'],
+        first_name=user.get('first_name'),
+        last_name=user.get('last_name'),
+        email=user.get('email'),
+        phone=user.get('phone'),
+        listing_url=user.get('listing_url')
+    )
+
 class Viewer(AnonymousUserMixin):
     def __init__(self, username=None, password=None, listing_url=None):
         self.username = username
@@ -1,11 +1,23 @@
 import secrets
 import string
 import base64
+import binascii
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps
+from config import Config
+from metrics import compression_duration, compression_size
+from uploads import UploadError, check_image
 import logging
 logger = logging.getLogger('lucky_house')
 
+# Pillow refuses to open anything bigger, whichever way the photo arrived
+Image.MAX_IMAGE_PIXELS = Config.PHOTO_MAX_PIXELS
+
 def generate_secure_token(length=32):
     """Generate a secure random token for URLs."""
     return secrets.token_urlsafe(length)
@@ -21,39 +33,189 @@ def generate_viewer_credentials(listing_url):
     
     return username, password 
 
-def compress_image(base64_string, max_size_kb=500):
+def decode_data_url(data_url):
+    """Decode a base64 photo (with or without a data URL prefix) into bytes."""
+    if ',' in data_url:
+        data_url = data_url.split(',')[1]
     try:
-        # Remove the data URL prefix if present
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        
-        # Convert base64 to image
-        image_data = base64.b64decode(base64_string)
-        img = Image.open(BytesIO(image_data))
-        
-        # Convert to RGB if image is in RGBA mode
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
-        
-        # Initial quality
-        quality = 95
+        return base64.b64decode(data_url)
+    except binascii.Error as e:
+        raise UploadError(f'Photo is not valid base64: {e}')
+
+def read_photo(photo):
+    """Original bytes of a photo given as base64 text, bytes or a binary file."""
+    if isinstance(photo, str):
+        return decode_data_url(photo)
+    if isinstance(photo, (bytes, bytearray)):
+        return bytes(photo)
+    photo.seek(0)
+    return photo.read()
+
+def photo_stream(photo):
+    """Seekable binary stream of a photo; files are handed over as they are."""
+    if isinstance(photo, (str, bytes, bytearray)):
+        return BytesIO(read_photo(photo))
+    photo.seek(0)
+    return photo
+
+def is_data_url(value):
+    return isinstance(value, str) and value.startswith('data:')
+
+def original_photo(photo):
+    """
+    {'full': original bytes} for a photo that could not be compressed, as long
+    as they are an image we accept. Raises UploadError otherwise.
+    """
+    data = read_photo(photo)
+    check_image(BytesIO(data))
+    return {'full': data}
+
+def encode_jpeg(img, max_size_kb, max_steps=Config.PHOTO_MAX_QUALITY_STEPS):
+    """
+    Binary search the highest JPEG quality in 5..95 that fits under max_size_kb,
+    spending at most max_steps encodes. The chosen quality is re-encoded once
+    with optimize=True, which only ever makes the file smaller.
+    """
+    low, high = 5, 95
+    best_quality = None
+    steps = 0
+    while low <= high and steps < max_steps:
+        quality = (low + high) // 2
         output = BytesIO()
-        
-        # Compress until size is under max_size_kb
-        while True:
-            output.seek(0)
-            output.truncate()
-            img.save(output, format='JPEG', quality=quality, optimize=True)
-            size_kb = len(output.getvalue()) / 1024
-            
-            if size_kb <= max_size_kb or quality <= 5:
-                break
-                
-            quality -= 5
-        
-        # Convert back to base64
-        compressed_base64 = base64.b64encode(output.getvalue()).decode('utf-8')
-        return f"data:image/jpeg;base64,{compressed_base64}"
+        img.save(output, format='JPEG', quality=quality)
+        steps += 1
+        if output.tell() / 1024 <= max_size_kb:
+            best_quality = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=best_quality or 5, optimize=True, progressive=True)
+    return output.getvalue()
+
+def compress_image(photo, renditions=None):
+    """
+    Decode a photo (base64 text, bytes or a binary file) once and encode it as
+    JPEG renditions, returning a dict of rendition name -> bytes.
+    Falls back to original_photo.
+    """
+    renditions = renditions or Config.PHOTO_RENDITIONS
+    try:
+        img = Image.open(photo_stream(photo))
+
+        # Let the JPEG decoder downscale by a power of two while decoding
+        max_edge = max(edge for edge, _ in renditions.values())
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_edge, max_edge))
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        # Largest first, so each smaller rendition resizes the previous one
+        compressed = {}
+        for name, (edge, max_size_kb) in sorted(renditions.items(), key=lambda item: -item[1][0]):
+            img.thumbnail((edge, edge), Image.LANCZOS)
+            compressed[name] = encode_jpeg(img, max_size_kb)
+        return compressed
     except Exception as e:
-        logger.error(f'Error compressing image: {e}')
-        return base64_string
\ No newline at end of file
+        logger.error('Error compressing image: %s', e)
+        return original_photo(photo)
+
+_compression_pool = None
+_compression_pool_lock = threading.Lock()
+# Photos submitted to the pool but not finished yet, across all requests
+_compression_slots = threading.BoundedSemaphore(Config.PHOTO_QUEUE_SIZE)
+
+def get_compression_pool():
+    """Lazily start the compression pool in the process that uses it."""
+    global _compression_pool
+    with _compression_pool_lock:
+        if _compression_pool is None:
+            # By now this process runs Mongo monitor and logging threads whose
+            # locks a plain fork would copy mid-use; workers come from a clean server,
+            # which only needs this module (not the __main__ script) preloaded
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['utils'])
+            _compression_pool = ProcessPoolExecutor(max_workers=Config.PHOTO_WORKERS, mp_context=context)
+        return _compression_pool
+
+def _reset_compression_pool(kill=False):
+    global _compression_pool
+    with _compression_pool_lock:
+        pool, _compression_pool = _compression_pool, None
+    if pool is not None:
+        if kill:
+            # shutdown() never interrupts a running task; killing its process does
+            for process in list((pool._processes or {}).values()):
+                process.kill()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def compress_images(photos):
+    """
+    Compress photos in parallel across the process pool, preserving order.
+    A photo that fails or exceeds PHOTO_TIMEOUT falls back to its original bytes
+    as its only rendition; UploadError if those are no image either.
+    Submissions block while PHOTO_QUEUE_SIZE photos are already in flight.
+    """
+    results = _compress_images(photos)
+    for renditions in results:
+        for name, data in renditions.items():
+            compression_size.observe(len(data), name)
+    return results
+
+def _compress_inline(photo):
+    started = time.monotonic()
+    renditions = compress_image(photo)
+    compression_duration.observe(time.monotonic() - started)
+    return renditions
+
+def _compression_done(future, started):
+    _compression_slots.release()
+    compression_duration.observe(time.monotonic() - started)
+
+def _compress_images(photos):
+    if Config.PHOTO_WORKERS <= 0:
+        return [_compress_inline(photo) for photo in photos]
+
+    submitted = []
+    for photo in photos:
+        _compression_slots.acquire()
+        try:
+            # Files cannot cross the process boundary, their bytes can
+            payload = photo if isinstance(photo, (str, bytes)) else read_photo(photo)
+            future = get_compression_pool().submit(compress_image, payload)
+        except (BrokenProcessPool, RuntimeError) as e:
+            _compression_slots.release()
+            logger.error('Compression pool unavailable, compressing inline: %s', e)
+            _reset_compression_pool()
+            submitted.append((photo, None, None))
+            continue
+        future.add_done_callback(lambda done, started=time.monotonic(): _compression_done(done, started))
+        submitted.append((photo, future, time.monotonic() + Config.PHOTO_TIMEOUT))
+
+    results = []
+    for photo, future, deadline in submitted:
+        if future is None:
+            results.append(_compress_inline(photo))
+            continue
+        try:
+            results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+        except TimeoutError:
+            if not future.cancel():
+                # A stuck photo would hold its worker and queue slot for good;
+                # its future fails with the pool, which frees the slot
+                _reset_compression_pool(kill=True)
+            logger.error('Compressing photo timed out after %ss, keeping original', Config.PHOTO_TIMEOUT)
+            results.append(original_photo(photo))
+        except BrokenProcessPool as e:
+            logger.error('Compression worker died, keeping original: %s', e)
+            _reset_compression_pool()
+            results.append(original_photo(photo))
+        except UploadError:
+            raise
+        except Exception as e:
+            logger.error('Error compressing image: %s', e)
+            results.append(original_photo(photo))
+    return results
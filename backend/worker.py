@@ -0,0 +1,89 @@
+"""
+Photo processing worker: compresses and stores the uploads queued by listing
+create/update and swaps them into their listings.
+
+    python worker.py
+
+Run as many as the host's CPUs allow; they share the queue in
+Config.JOBS_DATABASE. Each compresses through its own PHOTO_WORKERS pool.
+"""
+import argparse
+import time
+from io import BytesIO
+from config import Config
+import jobs
+from photo_store import store_uploads
+from repositories import storage
+from uploads import UploadError
+from logging_setup import configure_logging
+import logging
+logger = logging.getLogger('lucky_house')
+
+# Photo data that does not decode as an image fails alike on every attempt
+PERMANENT_ERRORS = (UploadError,)
+
+def process_job(job):
+    """Store the photos of a job that are not stored yet, a pool's worth at a time."""
+    pending = jobs.pending_photos(job['id'])
+    batch_size = max(Config.PHOTO_WORKERS, 1)
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        uploads = [row['data'] if isinstance(row['data'], str) else BytesIO(row['data']) for row in batch]
+        for row, file_id in zip(batch, store_uploads(uploads)):
+            storage.listings.replace_photo(job['listing_url'], jobs.placeholder(job['id'], row['position']), file_id)
+            jobs.photo_done(job['id'], row['position'], file_id)
+    storage.listings.release_photo_job(job['listing_url'], job['id'])
+    jobs.finish_job(job['id'])
+
+def give_up(job, error):
+    storage.listings.release_photo_job(job['listing_url'], job['id'], jobs.unfinished_placeholders(job['id']))
+    jobs.fail_job(job['id'], error)
+    logger.error('Photo job %s failed for good after %s attempts: %s', job['id'], job['attempts'], error)
+
+def run_once():
+    """Process one due job. Returns False when there was none."""
+    job = jobs.claim_job()
+    if job is None:
+        return False
+    if job['attempts'] > job['max_attempts']:
+        # Its last worker died holding the lease
+        give_up(job, job['error'] or 'Worker stopped while processing')
+        return True
+
+    logger.info('Processing photo job %s for listing %s (attempt %s)', job['id'], job['listing_url'], job['attempts'])
+    try:
+        process_job(job)
+        logger.info('Photo job %s done', job['id'])
+    except PERMANENT_ERRORS as e:
+        give_up(job, str(e))
+    except Exception as e:
+        if job['attempts'] >= job['max_attempts']:
+            give_up(job, str(e))
+        else:
+            delay = jobs.retry_job(job, str(e))
+            logger.error('Photo job %s failed, retrying in %ss: %s', job['id'], delay, e)
+    return True
+
+def run_worker(poll_interval=Config.JOB_POLL_INTERVAL):
+    while True:
+        try:
+            if not run_once():
+                time.sleep(poll_interval)
+        except Exception as e:
+            # e.g. the queue file is locked for longer than the busy timeout
+            logger.error('Photo worker error: %s', e)
+            time.sleep(poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--poll-interval', type=float, default=Config.JOB_POLL_INTERVAL,
+                        help='Seconds to wait when the queue is empty')
+    args = parser.parse_args()
+    configure_logging()
+    # Everything this process writes is background work
+    storage.use_profile('bulk')
+    logger.info('Photo worker started on %s', Config.JOBS_DATABASE)
+    run_worker(args.poll_interval)
+
+if __name__ == '__main__':
+    main()